@@ -1,31 +1,53 @@
 import csv
 import hashlib
-from io import StringIO
+import io
+import functools
+import glob
 from fastapi import APIRouter, Depends, UploadFile, Path, Form, status
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 import models.api as api
 import models.core as core
-from models.enums import ContentType, RequestType
+from models.enums import ContentType, RequestType, ResourceType
 import utils.db as db
+import utils.bulk as bulk
+import utils.journal as journal
+import utils.fs as fs
+import utils.csv_import as csv_import
+from utils.logger import logger
+from utils.schema_cache import schema_cache
 import utils.regex as regex
 import sys
-from jsonschema import validate
-import json
+from jsonschema import ValidationError
 from pathlib import Path as FSPath
 from utils.settings import settings
 from utils.jwt import JWTBearer
 
 router = APIRouter()
 
+# Row errors listed in the csv import response, all of them are counted
+MAX_REPORTED_ROW_ERRORS = 1000
+
+ROLLED_BACK = api.Error(
+    type="request", code=204, message="rolled back, another record failed"
+)
+
 
 @router.post("/query", response_model=api.Response, response_model_exclude_none=True)
 async def query_entries(query: api.Query,
     _=Depends(JWTBearer())) -> api.Response:
-    total, records = await db.serve_query(query)
+    if query.stream:
+        return StreamingResponse(
+            await db.stream_query(query), media_type="application/x-ndjson"
+        )
+
+    total, records, cursor = await db.serve_query(query)
+    attributes = {"total": total, "returned": len(records)}
+    if cursor:
+        attributes["cursor"] = cursor
     return api.Response(
         status=api.Status.success,
         records=records,
-        attributes={"total": total, "returned": len(records)},
+        attributes=attributes,
     )
 
 
@@ -50,108 +72,311 @@ async def serve_request( request: api.Request, owner_shortname=Depends(JWTBearer
             ),
         )
 
-    match request.request_type:
-        case api.RequestType.create:
-            for record in request.records:
-                resource_obj = core.Meta.from_record(record=record, shortname=owner_shortname)
-                # Check if the payload should goes in the meta file or in a separate file
-                # if record.payload_location:
-                #    db.save(request.space_name, record.subpath, resource_obj)
-                # else :
-
-                # Validate schema if present
-                if "schema_shortname" in record.attributes:
-                    schema_shortname = record.attributes["schema_shortname"]
-                    resource_obj.payload.schema_shortname = schema_shortname
-                    record.attributes.pop("schema_shortname")
-
-                    schema_payload_path = db.payload_path(
-                        request.space_name, "schema", core.Schema
-                    )
-                    validate_payload_with_schema(
-                        schema_path=schema_payload_path / f"{schema_shortname}.json",
-                        payload_data=record.attributes,
-                    )
-
-                separate_payload_data = {}
-                if resource_obj.payload:
-                    separate_payload_data = resource_obj.payload.body
-                    resource_obj.payload.body = record.shortname + ".json"
+    if request.atomic:
+        errors = await execute_atomic(
+            request.space_name, request.request_type, request.records, owner_shortname
+        )
+    else:
+        errors = await execute_records(
+            request.space_name, request.request_type, request.records, owner_shortname
+        )
 
-                await db.save(request.space_name, record.subpath, resource_obj)
+    # A single record keeps failing the way it always did
+    if len(request.records) == 1 and errors[0]:
+        raise errors[0]
+
+    results: list[dict] = []
+    failures: list[dict] = []
+    for record, error in zip(request.records, errors):
+        result = {
+            "resource_type": record.resource_type,
+            "subpath": record.subpath,
+            "shortname": record.shortname,
+            "status": api.Status.failed if error else api.Status.success,
+        }
+        if error:
+            result["error"] = record_error(error).dict()
+            failures.append(result)
+        elif request.atomic and failures_in(errors):
+            result["status"] = api.Status.failed
+            result["error"] = ROLLED_BACK.dict()
+        results.append(result)
+
+    if failures:
+        return api.Response(
+            status=api.Status.failed,
+            error=api.Error(
+                type="request",
+                code=203,
+                message=failures,
+            ),
+            attributes={"results": results},
+        )
+    return api.Response(status=api.Status.success, attributes={"results": results})
+
+
+def failures_in(errors: list[BaseException | None]) -> bool:
+    return any(error is not None for error in errors)
+
+
+async def execute_atomic(
+    space_name: str,
+    request_type: RequestType,
+    records: list[core.Record],
+    owner_shortname: str,
+) -> list[BaseException | None]:
+    """Like execute_records, but undo every record if any of them fails
+
+    The paths of the batch stay locked for other requests until the batch is
+    committed or rolled back
+    """
+    keys = [
+        key
+        for record in records
+        for key in record_keys(space_name, request_type, record)
+    ]
+    async with bulk.hold(keys):
+        undo = journal.Journal(space_name)
+        await fs.run(
+            "journal",
+            undo.capture,
+            [
+                path
+                for record in records
+                for path in record_paths(space_name, request_type, record)
+            ],
+            [
+                (
+                    subpath,
+                    shortname,
+                    record.resource_type.value,
+                    record.attributes.get("schema_shortname"),
+                )
+                for record in records
+                for subpath, shortname in record_locations(request_type, record)
+            ],
+        )
+        errors = await execute_records(
+            space_name, request_type, records, owner_shortname, held=True
+        )
+        if failures_in(errors):
+            await fs.run("journal", undo.rollback)
+            await fs.run("journal", db.rolled_back, space_name, undo.locations)
+        else:
+            await fs.run("journal", undo.discard)
+    return errors
+
+
+async def execute_records(
+    space_name: str,
+    request_type: RequestType,
+    records: list[core.Record],
+    owner_shortname: str,
+    held: bool = False,
+) -> list[BaseException | None]:
+    """Run the records concurrently, return None or the error of each one"""
+    match request_type:
+        case RequestType.create:
+            handler = create_record
+        case RequestType.update:
+            handler = update_record
+        case RequestType.delete:
+            handler = delete_record
+        case RequestType.move:
+            handler = move_record
+
+    return await bulk.execute(
+        [
+            (
+                record_keys(space_name, request_type, record),
+                functools.partial(handler, space_name, record, owner_shortname),
+            )
+            for record in records
+        ],
+        settings.bulk_parallelism,
+        held,
+    )
 
-                if separate_payload_data:
-                    await db.save_payload_from_json(
-                        request.space_name,
-                        record.subpath,
-                        resource_obj,
-                        separate_payload_data,
-                    )
 
-        case api.RequestType.update:
-            for record in request.records:
-                resource_obj = core.Meta.from_record(record=record, shortname=owner_shortname)
-                await db.update(request.space_name, record.subpath, resource_obj)
-        case api.RequestType.delete:
-            for record in request.records:
-                cls = getattr(
-                    sys.modules["models.core"], record.resource_type.capitalize()
+def record_locations(
+    request_type: RequestType, record: core.Record
+) -> list[tuple[str, str]]:
+    """(subpath, shortname) of the resources the record changes"""
+    locations = [(record.subpath, record.shortname)]
+    if request_type == RequestType.move:
+        for prefix in ("src", "dest"):
+            locations.append(
+                (
+                    str(record.attributes.get(f"{prefix}_subpath") or record.subpath),
+                    str(
+                        record.attributes.get(f"{prefix}_shortname")
+                        or record.shortname
+                    ),
                 )
-                item = db.load(
-                    request.space_name, record.subpath, record.shortname, cls
-                )
-                db.delete(request.space_name, record.subpath, item)
-        case api.RequestType.move:
-            for record in request.records:
-                if (
-                    "dest_subpath" not in record.attributes
-                    and not record.attributes["dest_subpath"]
-                ) and (
-                    "dest_shortname" not in record.attributes
-                    and not record.attributes["dest_shortname"]
-                ):
-                    raise api.Exception(
-                        status.HTTP_400_BAD_REQUEST,
-                        api.Error(
-                            type="move",
-                            code=202,
-                            message="Please provide a new path or a new shortname",
-                        ),
-                    )
+            )
+    return locations
 
-                if (
-                    "src_subpath" not in record.attributes
-                    and not record.attributes["src_subpath"]
-                ) and (
-                    "src_shortname" not in record.attributes
-                    and not record.attributes["src_shortname"]
-                ):
-                    raise api.Exception(
-                        status.HTTP_400_BAD_REQUEST,
-                        api.Error(
-                            type="move",
-                            code=202,
-                            message="Please provide a new path or a new shortname",
-                        ),
-                    )
-                cls = getattr(
-                    sys.modules["models.core"], record.resource_type.capitalize()
-                )
-                item = db.load(
-                    request.space_name,
-                    record.attributes["src_subpath"],
-                    record.attributes["src_shortname"],
-                    cls,
-                )
-                await db.move(
-                    request.space_name,
-                    record.attributes["src_subpath"],
-                    record.attributes["src_shortname"],
-                    record.attributes["dest_subpath"],
-                    record.attributes["dest_shortname"],
-                    item,
-                )
-    return api.Response(status=api.Status.success)
+
+def record_keys(
+    space_name: str, request_type: RequestType, record: core.Record
+) -> list[tuple]:
+    """Paths touched by the record, records sharing one are run in order"""
+    subtree = record.resource_type == ResourceType.folder and request_type in (
+        RequestType.move,
+        RequestType.delete,
+    )
+    keys: list[tuple] = []
+    for subpath, shortname in record_locations(request_type, record):
+        keys.append(bulk.path_key(space_name, subpath, shortname))
+        # Writes under a folder wait for a move or delete of that folder
+        keys.extend(bulk.ancestor_keys(space_name, subpath))
+        if subtree:
+            tree = "/".join(one for one in (subpath.strip("/"), shortname) if one)
+            keys.append(bulk.tree_key(space_name, tree))
+    return keys
+
+
+def record_paths(
+    space_name: str, request_type: RequestType, record: core.Record
+) -> list[FSPath]:
+    """Files and folders that the record may change, for the undo journal"""
+    cls = getattr(sys.modules["models.core"], record.resource_type.capitalize())
+    paths: list[FSPath] = []
+    for subpath, shortname in record_locations(request_type, record):
+        path, filename = db.metapath(space_name, subpath, shortname, cls)
+        if issubclass(cls, core.Space):
+            paths.append(path / filename)
+        # A folder is moved or deleted with its whole subtree
+        elif issubclass(cls, core.Folder) and request_type in (
+            RequestType.move,
+            RequestType.delete,
+        ):
+            paths.append(path.parent)
+        elif issubclass(cls, core.Folder):
+            paths.append(path / filename)
+        else:
+            paths.append(path)
+        if not issubclass(cls, core.Attachment):
+            folder = db.payload_path(space_name, subpath, cls)
+            paths.append(folder / f"{shortname}.json")
+            # Payloads uploaded as files keep their own extension
+            paths.extend(folder.glob(f"{glob.escape(shortname)}.*"))
+    return paths
+
+
+def record_error(error: BaseException) -> api.Error:
+    if isinstance(error, api.Exception):
+        return error.error
+    if isinstance(error, ValidationError):
+        return api.Error(type="validation", code=422, message=error.message)
+    return api.Error(type="internal", code=99, message=str(error))
+
+
+async def create_record(space_name: str, record: core.Record, owner_shortname: str):
+    resource_obj = core.Meta.from_record(record=record, shortname=owner_shortname)
+    # Check if the payload should goes in the meta file or in a separate file
+    # if record.payload_location:
+    #    db.save(space_name, record.subpath, resource_obj)
+    # else :
+
+    # Validate schema if present
+    if "schema_shortname" in record.attributes:
+        schema_shortname = record.attributes["schema_shortname"]
+        resource_obj.payload.schema_shortname = schema_shortname
+        record.attributes.pop("schema_shortname")
+
+        await validate_payload_with_schema(
+            space_name=space_name,
+            schema_shortname=schema_shortname,
+            payload_data=record.attributes,
+        )
+
+    separate_payload_data = {}
+    if resource_obj.payload:
+        separate_payload_data = resource_obj.payload.body
+        resource_obj.payload.body = record.shortname + ".json"
+        if separate_payload_data:
+            # The blob of the payload is released with the meta
+            resource_obj.payload.checksum = hashlib.sha1(
+                db.json_payload_bytes(separate_payload_data)
+            ).hexdigest()
+
+    await db.save(space_name, record.subpath, resource_obj)
+
+    if separate_payload_data:
+        await db.save_payload_from_json(
+            space_name,
+            record.subpath,
+            resource_obj,
+            separate_payload_data,
+        )
+
+
+async def update_record(space_name: str, record: core.Record, owner_shortname: str):
+    # The version the client read, the update is rejected if it changed since
+    attributes = dict(record.attributes)
+    if_version = attributes.pop("if_version", None)
+    attributes.pop("version", None)
+    resource_obj = core.Meta.from_record(
+        record=record.copy(update={"attributes": attributes}),
+        shortname=owner_shortname,
+    )
+    await db.update(space_name, record.subpath, resource_obj, if_version)
+
+
+async def delete_record(space_name: str, record: core.Record, _: str):
+    cls = getattr(sys.modules["models.core"], record.resource_type.capitalize())
+    item = await db.load(space_name, record.subpath, record.shortname, cls)
+    await db.delete(space_name, record.subpath, item)
+
+
+async def move_record(space_name: str, record: core.Record, _: str):
+    if (
+        "dest_subpath" not in record.attributes
+        and not record.attributes["dest_subpath"]
+    ) and (
+        "dest_shortname" not in record.attributes
+        and not record.attributes["dest_shortname"]
+    ):
+        raise api.Exception(
+            status.HTTP_400_BAD_REQUEST,
+            api.Error(
+                type="move",
+                code=202,
+                message="Please provide a new path or a new shortname",
+            ),
+        )
+
+    if (
+        "src_subpath" not in record.attributes
+        and not record.attributes["src_subpath"]
+    ) and (
+        "src_shortname" not in record.attributes
+        and not record.attributes["src_shortname"]
+    ):
+        raise api.Exception(
+            status.HTTP_400_BAD_REQUEST,
+            api.Error(
+                type="move",
+                code=202,
+                message="Please provide a new path or a new shortname",
+            ),
+        )
+    cls = getattr(sys.modules["models.core"], record.resource_type.capitalize())
+    item = await db.load(
+        space_name,
+        record.attributes["src_subpath"],
+        record.attributes["src_shortname"],
+        cls,
+    )
+    await db.move(
+        space_name,
+        record.attributes["src_subpath"],
+        record.attributes["src_shortname"],
+        record.attributes["dest_subpath"],
+        record.attributes["dest_shortname"],
+        item,
+    )
 
 
 @router.get(
@@ -168,7 +393,7 @@ async def retrieve_entry_or_attachment_payload(
 ) -> FileResponse:
 
     cls = getattr(sys.modules["models.core"], resource_type.capitalize())
-    meta = db.load(space_name, subpath, shortname, cls)
+    meta = await db.load(space_name, subpath, shortname, cls)
     if (
         meta.payload is None
         or meta.payload.body is None
@@ -224,16 +449,7 @@ async def create_or_update_resource_with_payload(
         )
 
     record = core.Record.parse_raw(request_record.file.read())
-    sha1 = hashlib.sha1()
-    sha1.update(payload_file.file.read())
-    checksum = sha1.hexdigest()
-    await payload_file.seek(0)
     resource_obj = core.Meta.from_record(record=record, shortname=owner_shortname)
-    resource_obj.payload = core.Payload(
-        content_type=resource_content_type,
-        checksum=checksum,
-        body=f"{record.shortname}." + payload_file.filename.split(".")[1],
-    )
 
     if (
         not isinstance(resource_obj, core.Attachment)
@@ -249,32 +465,45 @@ async def create_or_update_resource_with_payload(
             ),
         )
 
-    if (
-        resource_content_type == ContentType.json
-        and "schema_shortname" in record.attributes
-    ):
-        resource_obj.payload.schema_shortname = record.attributes["schema_shortname"]
-        schema_payload_path = db.payload_path(space_name, "schema", core.Schema)
-        validate_payload_with_schema(
-            schema_path=schema_payload_path
-            / f"{resource_obj.payload.schema_shortname}.json",
-            payload_data=payload_file,
+    # The upload is hashed while it is written, and only read back for validation
+    staged = await db.stage_payload(
+        space_name, record.subpath, resource_obj, payload_file
+    )
+    try:
+        resource_obj.payload = core.Payload(
+            content_type=resource_content_type,
+            checksum=staged.checksum,
+            body=f"{record.shortname}." + payload_file.filename.split(".")[1],
         )
 
-    await db.save(space_name, record.subpath, resource_obj)
-    await db.save_payload(space_name, record.subpath, resource_obj, payload_file)
-    return api.Response(status=api.Status.success)
+        if (
+            resource_content_type == ContentType.json
+            and "schema_shortname" in record.attributes
+        ):
+            resource_obj.payload.schema_shortname = record.attributes[
+                "schema_shortname"
+            ]
+            await validate_payload_with_schema(
+                space_name=space_name,
+                schema_shortname=resource_obj.payload.schema_shortname,
+                payload_data=await fs.run("payload", db.read_json_payload, staged.tmp),
+            )
 
+        await db.save(space_name, record.subpath, resource_obj)
+    except BaseException:
+        await db.discard_payload(staged)
+        raise
+    await db.save_payload(space_name, record.subpath, resource_obj, staged)
+    return api.Response(status=api.Status.success)
 
-def validate_payload_with_schema(schema_path: FSPath, payload_data: UploadFile | dict):
-    schema = json.loads(FSPath(schema_path).read_text())
-    if not isinstance(payload_data, dict):
-        data = json.load(payload_data.file)
-        payload_data.file.seek(0)
-    else:
-        data = payload_data
 
-    validate(instance=data, schema=schema)
+async def validate_payload_with_schema(
+    space_name: str, schema_shortname: str, payload_data: dict
+):
+    # Reading (and rebuilding) the validator may hit the disk
+    await fs.run(
+        "schema", schema_cache.validate, space_name, schema_shortname, payload_data
+    )
 
 
 @router.post(
@@ -291,88 +520,101 @@ async def import_resources_from_csv(
     owner_shortname=Depends(JWTBearer()),
 ):
 
-    contents = await resources_file.read()
-    decoded = contents.decode()
-    buffer = StringIO(decoded)
-    csv_reader = csv.DictReader(buffer)
+    if space_name not in settings.space_names:
+        raise api.Exception(
+            status.HTTP_400_BAD_REQUEST,
+            api.Error(
+                type="reqeust",
+                code=202,
+                message="Space name provided is empty or invalid",
+            ),
+        )
+    try:
+        validator = await fs.run(
+            "schema", schema_cache.get, space_name, schema_shortname
+        )
+        schema_content = validator.schema
+    except FileNotFoundError:
+        raise api.Exception(
+            status.HTTP_404_NOT_FOUND,
+            api.Error(type="csv", code=231, message="schema not found"),
+        )
+
+    # The upload is decoded and parsed incrementally, one chunk at a time
+    text_file = io.TextIOWrapper(resources_file.file, encoding="utf-8", newline="")
+    reader = csv.reader(text_file)
+    header = await fs.run("csv", next, reader, [])
+    try:
+        shortname_index, plans = csv_import.compile_plan(header, schema_content)
+    except csv_import.PlanError as e:
+        raise api.Exception(
+            status.HTTP_400_BAD_REQUEST,
+            api.Error(type="csv", code=232, message=str(e)),
+        )
 
-    schema_path = (
-        db.payload_path(space_name, "schema", core.Schema) / f"{schema_shortname}.json"
-    )
-    with open(schema_path) as schema_file:
-        schema_content = json.load(schema_file)
-
-    data_types_mapper = {
-        "integer": int, 
-        "number": float, 
-        "string": str, 
-        "array": json.loads
-    }
-
-    records: list = []
-    for row in csv_reader:
-        shortname: str = ""
-        payload_object: dict = {}
-        for key, value in row.items():
-            if not key:
-                continue
+    total = imported = failed_count = 0
+    failures: list[dict] = []
 
-            if key == "shortname":
-                shortname = value
-                continue
+    def failed(row: int, shortname: str, error: api.Error):
+        nonlocal failed_count
+        failed_count += 1
+        if len(failures) < MAX_REPORTED_ROW_ERRORS:
+            failures.append(
+                {"row": row, "shortname": shortname, "error": error.dict()}
+            )
 
-            keys_list = key.split(".")
-            current_schema_property = schema_content
-            for item in keys_list:
-                current_schema_property = current_schema_property["properties"][
-                    item.strip()
-                ]
-
-            match current_schema_property["type"]:
-                case "string":
-                    value = value or "null"
-                case "array":
-                    value = value or "[]"
-                case _:
-                    value = value or "0"
-                    value = value.replace(",", "")
-            
-            value = data_types_mapper[current_schema_property["type"]](value)
-            if current_schema_property["type"] == "array":
-                value = [str(item) for item in value]
-
-
-            match len(keys_list):
-                case 1:
-                    payload_object[keys_list[0].strip()] = value
-                case 2:
-                    if keys_list[0].strip() not in payload_object:
-                        payload_object[keys_list[0].strip()] = {}
-                    payload_object[keys_list[0].strip()][keys_list[1].strip()] = value
-                case 3:
-                    if keys_list[0].strip() not in payload_object:
-                        payload_object[keys_list[0].strip()] = {}
-                    if keys_list[1].strip() not in payload_object[keys_list[0].strip()]:
-                        payload_object[keys_list[0].strip()][keys_list[1].strip()] = {}
-                    payload_object[keys_list[0].strip()][keys_list[1].strip()][
-                        keys_list[2].strip()
-                    ] = value
-                case _:
-                    continue
-
-        if shortname:
-            records.append(
-                core.Record(
-                    resource_type=resource_type,
-                    shortname=shortname,
-                    subpath=subpath,
-                    attributes=payload_object,
+    while rows := await fs.run(
+        "csv", csv_import.read_chunk, reader, settings.csv_import_chunk
+    ):
+        records: list[core.Record] = []
+        record_rows: list[int] = []
+        for row in rows:
+            # Data rows are numbered from 1, after the header
+            total += 1
+            shortname = ""
+            if shortname_index is not None and shortname_index < len(row):
+                shortname = row[shortname_index]
+            if not shortname:
+                failed(
+                    total,
+                    shortname,
+                    api.Error(type="validation", code=422, message="missing shortname"),
                 )
-            )
+                continue
+            try:
+                records.append(
+                    core.Record(
+                        resource_type=resource_type,
+                        shortname=shortname,
+                        subpath=subpath,
+                        attributes=csv_import.row_payload(plans, row),
+                    )
+                )
+                record_rows.append(total)
+            except ValueError as e:
+                failed(
+                    total,
+                    shortname,
+                    api.Error(type="validation", code=422, message=str(e)),
+                )
+
+        errors = await execute_records(
+            space_name, RequestType.create, records, owner_shortname
+        )
+        for row_number, record, error in zip(record_rows, records, errors):
+            if error:
+                failed(row_number, record.shortname, record_error(error))
+            else:
+                imported += 1
+        logger.info(
+            f"Imported {imported} of {total} csv rows into {space_name}/{subpath}"
+        )
 
-    return await serve_request(
-        request=api.Request(
-            space_name=space_name, request_type=RequestType.create, records=records
-        ),
-        owner_shortname=owner_shortname,
-    )
\ No newline at end of file
+    attributes = {"total": total, "imported": imported, "failed": failed_count}
+    if failures:
+        return api.Response(
+            status=api.Status.failed,
+            error=api.Error(type="csv", code=233, message=failures),
+            attributes=attributes,
+        )
+    return api.Response(status=api.Status.success, attributes=attributes)
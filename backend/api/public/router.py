@@ -4,7 +4,7 @@ import utils.db as db
 import models.api as api
 import utils.regex as regex
 import models.core as core
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from typing import Any
 import sys
 
@@ -15,11 +15,19 @@ router = APIRouter()
 
 @router.post("/query", response_model=api.Response, response_model_exclude_none=True)
 async def query_entries(query: api.Query) -> api.Response:
-    total, records = await db.serve_query(query)
+    if query.stream:
+        return StreamingResponse(
+            await db.stream_query(query), media_type="application/x-ndjson"
+        )
+
+    total, records, cursor = await db.serve_query(query)
+    attributes = {"total": total, "returned": len(records)}
+    if cursor:
+        attributes["cursor"] = cursor
     return api.Response(
         status=api.Status.success,
         records=records,
-        attributes={"total": total, "returned": len(records)},
+        attributes=attributes,
     )
 
 
@@ -34,7 +42,7 @@ async def retrieve_entry_meta(
     shortname: str = Path(..., regex=regex.SHORTNAME),
 ) -> dict[str, Any]:
     resource_class = getattr(sys.modules["models.core"], resource_type.title())
-    meta = db.load(space_name, subpath, shortname, resource_class)
+    meta = await db.load(space_name, subpath, shortname, resource_class)
     if meta is None:
         raise api.Exception(
             status.HTTP_400_BAD_REQUEST,
@@ -61,7 +69,7 @@ async def retrieve_entry_or_attachment_payload(
     ext: str = Path(..., regex=regex.EXT),
 ) -> FileResponse:
     resource_class = getattr(sys.modules["models.core"], resource_type.title())
-    meta = db.load(space_name, subpath, shortname, resource_class)
+    meta = await db.load(space_name, subpath, shortname, resource_class)
     if (
         meta.payload is None
         or meta.payload.body is None
@@ -97,10 +105,18 @@ async def query_via_urlparams(
     query: api.Query = Depends(api.Query),
 ) -> api.Response:
 
-    total, records = await db.serve_query(query)
+    if query.stream:
+        return StreamingResponse(
+            await db.stream_query(query), media_type="application/x-ndjson"
+        )
+
+    total, records, cursor = await db.serve_query(query)
+    attributes = {"total": total, "returned": len(records)}
+    if cursor:
+        attributes["cursor"] = cursor
 
     return api.Response(
         status=api.Status.success,
         records=records,
-        attributes={"total": total, "returned": len(records)},
+        attributes=attributes,
     )
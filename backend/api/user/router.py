@@ -56,7 +56,7 @@ async def create_user(record: core.Record) -> api.Response:
 
 @router.get("/profile", response_model=api.Response, response_model_exclude_none=True)
 async def get_profile(shortname=Depends(JWTBearer())) -> api.Response:
-    user = db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
+    user = await db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
     attributes: dict[str, Any] = {}
     if user.email:
         attributes["email"] = user.email
@@ -76,7 +76,7 @@ async def update_profile(
     profile: core.Record, shortname=Depends(JWTBearer())
 ) -> api.Response:
     """Update user profile"""
-    user = db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
+    user = await db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
 
     if "password" in profile.attributes:
         user.password = profile.attributes["password"]
@@ -87,7 +87,13 @@ async def update_profile(
     if "email" in profile.attributes:
         user.email = profile.attributes["email"]
 
-    await db.update(MANAGEMENT_SPACE, USERS_SUBPATH, user)
+    # Fails with a conflict if the profile changed since it was loaded
+    await db.update(
+        MANAGEMENT_SPACE,
+        USERS_SUBPATH,
+        user,
+        profile.attributes.get("if_version", user.version),
+    )
     return api.Response(status=api.Status.success)
 
 
@@ -102,7 +108,7 @@ async def login(
     password: str = Body(..., regex=regex.PASSWORD),
 ) -> api.Response:
     """Login and generate refresh token"""
-    user = db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
+    user = await db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
     if user and user.password == password:
         access_token = sign_jwt({"username": shortname}, settings.jwt_access_expires)
         response.set_cookie(
@@ -133,6 +139,6 @@ async def login(
 @router.post("/delete", response_model=api.Response, response_model_exclude_none=True)
 async def delete_account(shortname=Depends(JWTBearer())) -> api.Response:
     """Delete own user"""
-    user = db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
-    db.delete(MANAGEMENT_SPACE, USERS_SUBPATH, user)
+    user = await db.load(MANAGEMENT_SPACE, USERS_SUBPATH, shortname, core.User)
+    await db.delete(MANAGEMENT_SPACE, USERS_SUBPATH, user)
     return api.Response(status=api.Status.success)
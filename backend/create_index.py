@@ -1,5 +1,6 @@
 #!/usr/bin/env -S BACKEND_ENV=config.env python
 
+import asyncio
 import json
 import re
 import models.api as api
@@ -12,7 +13,7 @@ from utils.settings import settings
 import utils.regex as regex
 
 
-def load_data_to_redis(space_name, subpath):
+async def load_data_to_redis(space_name, subpath):
     """
     Load meta files inside subpath then store them to redis as :space_name:meta prefixed doc,
     and if the meta file has a separate payload file follwing a schema we loads the payload content and store it to redis as :space_name:schema_name prefixed doc
@@ -33,13 +34,13 @@ def load_data_to_redis(space_name, subpath):
                 sys.modules["models.core"], core.ResourceType("content").title()
             )
             # print("\n\n\n", "\n space_name: ", space_name, "\n subpath: ", one.subpath, "\n shortname: ", one.shortname, "\n class_type: ", myclass)
-            meta = db.load(
+            meta = await db.load(
                 space_name=space_name,
                 subpath=one.subpath,
                 shortname=one.shortname,
                 class_type=myclass,
             )
-            redis_services.save_meta_doc(
+            await redis_services.save_meta_doc(
                 space_name=space_name,
                 schema_shortname="meta",
                 subpath=subpath,
@@ -54,7 +55,7 @@ def load_data_to_redis(space_name, subpath):
                     meta.payload.body
                 )
                 payload_data = json.loads(payload_path.read_text())
-                redis_services.save_payload_doc(
+                await redis_services.save_payload_doc(
                     space_name=space_name,
                     schema_shortname=meta.payload.schema_shortname,
                     payload_shortname=meta.payload.body.split(".")[0],
@@ -67,7 +68,7 @@ def load_data_to_redis(space_name, subpath):
     print(f"Added {loaded_to_redis} document to redis from {space_name}/{subpath}")
 
 
-def load_all_spaces_data_to_redis():
+async def load_all_spaces_data_to_redis():
     """
     Loop over spaces and subpaths inside it and load the data to redis of indexing_enabled for the space
     """
@@ -90,13 +91,58 @@ def load_all_spaces_data_to_redis():
 
         for subpath in path.iterdir():
             if subpath.is_dir() and re.match(regex.SUBPATH, subpath.name):
-                load_data_to_redis(space_name, subpath.name)
+                await load_data_to_redis(space_name, subpath.name)
 
 
-if __name__ == "__main__":
+def meta_on_disk(space_name: str, doc: dict) -> bool:
+    """Whether the meta a redis document was made from still exists"""
+    try:
+        myclass = getattr(sys.modules["models.core"], doc["resource_type"].title())
+        path, filename = db.metapath(
+            space_name, doc["subpath"] or "/", doc["shortname"], myclass
+        )
+    except (KeyError, AttributeError, ValueError):
+        return True
+    return (path / filename).is_file()
+
+
+async def remove_stale_docs(index_name: str) -> int:
+    """
+    Delete the documents of the index whose meta file is gone, the old index
+    versions were dropped without their documents
+    """
+    alias = redis_services.index_alias(index_name)
+    space_name = alias.split(":")[0]
+    removed = 0
+    async for docids in redis_services.scan_docs(alias):
+        docs = await redis_services.get_docs_by_ids(docids)
+        stale = [
+            docid for docid, doc in docs.items() if not meta_on_disk(space_name, doc)
+        ]
+        if stale:
+            await redis_services.write_docs(dict.fromkeys(stale))
+        removed += len(stale)
+    return removed
+
+
+async def main():
+    """
+    Build new versions of the indexes while the current ones keep serving
+    searches, load the documents, then swap each alias to its new version
+    """
     print("Creating Redis indexes")
-    redis_services.create_indices_for_all_spaces_meta_and_schemas()
-    load_all_spaces_data_to_redis()
+    created = await redis_services.create_indices_for_all_spaces_meta_and_schemas()
+    await load_all_spaces_data_to_redis()
+    for index_name in created:
+        await redis_services.wait_indexed(index_name)
+        await redis_services.swap_index(index_name)
+        removed = await remove_stale_docs(index_name)
+        print(f"Now serving {index_name}, removed {removed} stale documents")
+    await redis_services.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
 
     # test_search = redis_services.search(
     #     space_name="products",
@@ -29,6 +29,15 @@ import json
 from typing import Any
 from fastapi.middleware.cors import CORSMiddleware
 from utils.settings import settings
+from utils.space_registry import space_registry
+import utils.fs as fs
+import utils.journal as journal
+import utils.db as db
+from utils.durable import group_commit
+from utils.meta_cache import meta_cache
+from utils.indexer import indexer
+import utils.redis_services as redis_services
+from utils.reclaimer import reclaimer
 from urllib.parse import urlparse
 
 app = FastAPI(
@@ -63,8 +72,6 @@ app = FastAPI(
 json_logging.init_fastapi(enable_json=True)
 # json_logging.init_request_instrument(app)
 
-spaces: dict[str, core.Space] = {}
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -108,13 +115,22 @@ async def app_startup():
             if responses.get("422"):
                 responses.pop("422")
     app.openapi_schema = openapi_schema
-    for space_name in settings.space_names:
-        space_meta_file = settings.spaces_folder / space_name / ".dm/meta.space.json"
-        spaces[space_name] = core.Space.parse_raw(space_meta_file.read_text())
+    spaces = await fs.run("spaces", space_registry.refresh)
+    for space_name in spaces:
+        # Batches interrupted by a crash are undone before serving
+        for undone in await fs.run("journal", journal.recover, space_name):
+            await fs.run("journal", db.rolled_back, space_name, undone.locations)
+            logger.info(f"Rolled back an interrupted request of {space_name}")
+    indexer.start()
+    # Trash left by an earlier run is reclaimed again
+    reclaimer.start(list(spaces))
 
 
 @app.on_event("shutdown")
 async def app_shutdown():
+    await indexer.stop()
+    await reclaimer.stop()
+    await redis_services.close()
     logger.info("Application shutdown")
 
 
@@ -129,14 +145,16 @@ async def middle(request: Request, call_next):
     exception_data: dict[str, Any] | None = None
     try:
         response = await call_next(request)
-        raw_response = [section async for section in response.body_iterator]
-        response.body_iterator = iterate_in_threadpool(iter(raw_response))
-        raw_data = b"".join(raw_response)
-        if raw_data:
-            try:
-                response_body = json.loads(raw_data)
-            except:
-                response_body = ""
+        # Streamed responses are passed through without buffering their body
+        if response.headers.get("content-type") != "application/x-ndjson":
+            raw_response = [section async for section in response.body_iterator]
+            response.body_iterator = iterate_in_threadpool(iter(raw_response))
+            raw_data = b"".join(raw_response)
+            if raw_data:
+                try:
+                    response_body = json.loads(raw_data)
+                except:
+                    response_body = ""
     except api.Exception as ex:
         response = JSONResponse(
             status_code=ex.status_code,
@@ -236,6 +254,12 @@ async def root():
         "status": "Up and running",
         "date": datetime.now(),
         "status": "success",
+        "indexer": indexer.stats(),
+        "redis_pool": redis_services.pool.stats(),
+        "reclaimer": reclaimer.stats(),
+        "fs": fs.metrics(),
+        "meta_cache": meta_cache.stats(),
+        "group_commit": group_commit.stats(),
     }
 
 
@@ -13,6 +13,7 @@ class Request(BaseModel):
     space_name: str = Field(..., regex=regex.SPACENAME)
     request_type: RequestType
     records: list[core.Record]
+    atomic: bool = False  # all the records are applied, or none
 
 
 class QueryType(str, Enum):
@@ -24,6 +25,12 @@ class QueryType(str, Enum):
     spaces = "spaces"
 
 
+class AttachmentsMode(str, Enum):
+    none = "none"
+    counts = "counts"  # number of attachments per resource type
+    full = "full"
+
+
 class Query(BaseModel):
     type: QueryType
     space_name: str = Field(..., regex=regex.SPACENAME)
@@ -41,8 +48,11 @@ class Query(BaseModel):
     include_fields: list[str] | None = None
     sort_by: str | None = None
     retrieve_json_payload: bool = False
+    attachments_mode: AttachmentsMode = AttachmentsMode.full
+    stream: bool = False  # respond with application/x-ndjson, one record per line
     limit: int = 10
     offset: int = 0
+    after: str | None = None  # cursor returned by the previous page, replaces offset
 
 
 class Status(str, Enum):
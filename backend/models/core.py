@@ -42,7 +42,7 @@ class Record(BaseModel):
     shortname: str = Field(regex=regex.SHORTNAME)
     subpath: str = Field(regex=regex.SUBPATH)
     attributes: dict[str, Any]
-    attachments: dict[ResourceType, list[Any]] | None = None
+    attachments: dict[ResourceType, list[Any] | int] | None = None
 
 
 class Meta(Resource):
@@ -56,6 +56,8 @@ class Meta(Resource):
     updated_at: datetime = datetime.now()
     owner_shortname: str
     payload: Payload | None = None
+    # Bumped by every update, see db.update_meta
+    version: int = 0
 
     @staticmethod
     def from_record(record: Record, shortname: str):
@@ -89,7 +91,13 @@ class Meta(Resource):
         if len(payload_body) > 0:
             self.payload = Payload(content_type=ContentType.json, body=payload_body)
 
-    def to_record(self, subpath: str, shortname: str, include: list[str]):
+    def to_record(
+        self,
+        subpath: str,
+        shortname: str,
+        include: list[str],
+        exclude: list[str] | None = None,
+    ):
         # Sanity check
         assert self.shortname == shortname
         fields = {
@@ -118,6 +126,10 @@ class Meta(Resource):
             attributes["checksum"] = self.payload.checksum
         if self.tags:
             attributes["tags"] = self.tags
+        attributes["version"] = self.version
+
+        for key in exclude or []:
+            attributes.pop(key, None)
 
         fields["attributes"] = attributes
 
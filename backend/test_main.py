@@ -4,6 +4,7 @@ import os
 from test_utils import check_not_found, check_validation
 import test_managed as managed
 from utils.settings import settings
+from utils.meta_cache import meta_cache
 
 from main import app
 
@@ -111,14 +112,53 @@ def test_update_profile():
     assert json_response["status"] == "success"
 
 
+def test_profile_meta_cache():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/user/profile"
+    client.get(endpoint, headers=headers)
+    hits = meta_cache.hits
+    response = client.get(endpoint, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert meta_cache.hits == hits + 1
+
+    request_data = {
+        "resource_type": "user",
+        "subpath": "users",
+        "shortname": shortname,
+        "attributes": {"displayname": "Ali"},
+    }
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    response = client.get(endpoint, headers=headers)
+    assert response.json()["records"][0]["attributes"]["displayname"] == "Ali"
+
+
 if __name__ == "__main__":
     test_create_user()
     test_login()
     test_get_profile()
     test_update_profile()
+    test_profile_meta_cache()
     managed.test_create_content_resource()
     managed.test_create_comment_resource()
     managed.test_create_folder_resource()
     managed.test_upload_attachment_with_payload()
     managed.test_query_subpath()
+    managed.test_query_subpath_cursor()
+    managed.test_query_subpath_stream()
+    managed.test_query_subpath_projection()
+    managed.test_query_subpath_catalog()
+    managed.test_query_subpath_attachments_mode()
+    managed.test_query_spaces_registry()
+    managed.test_request_partial_failure()
+    managed.test_update_version_conflict()
+    managed.test_request_atomic_rollback()
+    managed.test_upload_deduplicated_payload()
+    managed.test_import_resources_from_csv()
+    managed.test_move_and_delete_folder_subtree()
+    managed.test_delete_attachment_payload_only()
+    managed.test_bulk_keeps_request_order()
+    managed.test_group_commit()
+    managed.test_search_page()
+    managed.test_schema_cache()
     managed.test_delete_all()
@@ -1,10 +1,29 @@
+import asyncio
+import hashlib
 import json
 import shutil
+import tempfile
+import threading
+from types import SimpleNamespace
 from fastapi.testclient import TestClient
 from fastapi import status
 from test_utils import check_validation, assert_code_and_status_success, check_not_found
 from utils.settings import settings
+import models.api as api
+import models.core as core
+import utils.catalog as catalog
+import utils.db as db
+import utils.durable as durable
+from utils.indexer import indexer
+from utils.meta_cache import meta_cache
+from utils.schema_cache import schema_cache
+from utils.space_registry import space_registry
+import utils.blobs as blobs
+import utils.bulk as bulk
+import utils.journal as journal
+from utils.reclaimer import reclaimer, trash_path
 import os
+from pathlib import Path
 
 from main import app
 
@@ -209,6 +228,735 @@ def test_query_subpath():
     )
 
 
+def crawl_subpath_with_cursor():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/query"
+    request_data = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": subpath,
+        "filter_shortnames": [shortname],
+        "limit": 1,
+    }
+    seen = []
+    while True:
+        response = client.post(endpoint, json=request_data, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        json_response = response.json()
+        assert json_response["attributes"]["total"] == 2
+        seen.extend(record["resource_type"] for record in json_response["records"])
+        if "cursor" not in json_response["attributes"]:
+            break
+        request_data["after"] = json_response["attributes"]["cursor"]
+    assert seen == ["content", "folder"]
+
+
+def test_query_subpath_cursor():
+    crawl_subpath_with_cursor()
+
+    headers = {"Content-Type": "application/json"}
+    forged = [{"p": 5}, {"p": [1]}, {"p": ["entry", "stuff"]}, {"p": [1, 2, 3]}]
+    for cursor in ["not-a-cursor"] + [db.encode_cursor(one) for one in forged]:
+        response = client.post(
+            "/managed/query",
+            json={
+                "type": "subpath",
+                "space_name": PRODUCTS_SPACE,
+                "subpath": subpath,
+                "after": cursor,
+            },
+            headers=headers,
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["error"]["code"] == 13
+
+
+def test_query_subpath_stream():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/query"
+    request_data = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": subpath,
+        "filter_shortnames": [shortname],
+        "limit": 1,
+        "stream": True,
+    }
+
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 2
+    assert lines[0]["resource_type"] == "content"
+    assert lines[1]["status"] == "success"
+    assert lines[1]["attributes"]["total"] == 2
+    assert lines[1]["attributes"]["returned"] == 1
+    assert "cursor" in lines[1]["attributes"]
+
+    response = client.post(
+        endpoint, json={**request_data, "after": "not-a-cursor"}, headers=headers
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_query_subpath_projection():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/query"
+    request_data = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": subpath,
+        "filter_shortnames": [shortname],
+        "filter_types": ["content", "comment"],
+        "include_fields": ["body"],
+    }
+
+    # Projected metas are only decoded on cache misses
+    meta_cache.clear()
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    record = response.json()["records"][0]
+    assert record["attributes"]["payload"] == f"{shortname}.json"
+    comment = record["attachments"]["comment"][0]
+    assert comment["attributes"]["body"] == "A very speed car"
+
+    request_data["include_fields"] = None
+    request_data["exclude_fields"] = ["payload", "body"]
+    response = client.post(endpoint, json=request_data, headers=headers)
+    record = response.json()["records"][0]
+    assert "payload" not in record["attributes"]
+    assert "body" not in record["attachments"]["comment"][0]["attributes"]
+
+
+def test_query_subpath_catalog():
+    settings.catalog_enabled = True
+    catalog.rebuild(PRODUCTS_SPACE)
+    try:
+        headers = {"Content-Type": "application/json"}
+        endpoint = "/managed/query"
+        request_data = {
+            "type": "subpath",
+            "space_name": PRODUCTS_SPACE,
+            "subpath": subpath,
+            "filter_types": ["content", "comment", "folder", "media"],
+            "filter_shortnames": [shortname],
+            "limit": 2,
+            "offset": 0,
+        }
+
+        response = client.post(endpoint, json=request_data, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        json_response = response.json()
+        assert json_response["attributes"]["total"] == 2
+        assert json_response["attributes"]["returned"] == 2
+        assert json_response["records"][0]["resource_type"] == "content"
+        assert "comment" in json_response["records"][0]["attachments"]
+        assert json_response["records"][1]["resource_type"] == "folder"
+
+        response = client.post(
+            endpoint, json={**request_data, "offset": 1}, headers=headers
+        )
+        assert response.json()["attributes"]["returned"] == 1
+        assert response.json()["records"][0]["resource_type"] == "folder"
+
+        response = client.post(
+            endpoint, json={**request_data, "filter_tags": ["nothing"]}, headers=headers
+        )
+        assert response.json()["attributes"]["total"] == 1
+
+        crawl_subpath_with_cursor()
+    finally:
+        settings.catalog_enabled = False
+        catalog.reset(PRODUCTS_SPACE)
+
+
+def test_query_subpath_attachments_mode():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/query"
+    request_data = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": subpath,
+        "filter_shortnames": [shortname],
+        "limit": 1,
+    }
+
+    response = client.post(
+        endpoint, json={**request_data, "attachments_mode": "counts"}, headers=headers
+    )
+    assert_code_and_status_success(response)
+    attachments = response.json()["records"][0]["attachments"]
+    assert attachments["comment"] == 1
+    assert attachments["media"] == 1
+
+    response = client.post(
+        endpoint, json={**request_data, "attachments_mode": "none"}, headers=headers
+    )
+    assert_code_and_status_success(response)
+    assert not response.json()["records"][0].get("attachments")
+
+
+def test_query_spaces_registry():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/query"
+    request_data = {"type": "spaces", "space_name": PRODUCTS_SPACE, "subpath": "/"}
+
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert_code_and_status_success(response)
+    shortnames = [one["shortname"] for one in response.json()["records"]]
+    assert PRODUCTS_SPACE in shortnames and DEMO_SPACE in shortnames
+
+    reloads = space_registry.reloads
+    client.post(endpoint, json=request_data, headers=headers)
+    assert space_registry.reloads == reloads
+
+    listed = space_registry.refresh()
+    space_registry.notify()
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert space_registry.reloads == reloads + 1
+    # A reload swaps in a new dict, the one handed out before is left as is
+    assert space_registry.refresh() is not listed
+    assert list(listed) == shortnames
+    assert response.json()["attributes"]["total"] == len(shortnames)
+
+
+def test_request_partial_failure():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/request"
+    record = {
+        "resource_type": "content",
+        "subpath": subpath,
+        "shortname": shortname,
+        "attributes": {"body": "2 door only"},
+    }
+    request_data = {
+        "space_name": PRODUCTS_SPACE,
+        "request_type": "update",
+        "records": [record, {**record, "shortname": "missing"}],
+    }
+
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    json_response = response.json()
+    assert json_response["status"] == "failed"
+    results = json_response["attributes"]["results"]
+    assert [one["status"] for one in results] == ["success", "failed"]
+    assert results[1]["error"]["type"] == "update"
+    assert json_response["error"]["message"][0]["shortname"] == "missing"
+
+
+def test_update_version_conflict():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/request"
+    with open(f"{dirpath}/meta.content.json") as file:
+        version = json.load(file).get("version", 0)
+    request_data = {
+        "space_name": PRODUCTS_SPACE,
+        "request_type": "update",
+        "records": [
+            {
+                "resource_type": "content",
+                "subpath": subpath,
+                "shortname": shortname,
+                "attributes": {"body": "3 doors", "if_version": version},
+            }
+        ],
+    }
+
+    assert_code_and_status_success(
+        client.post(endpoint, json=request_data, headers=headers)
+    )
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json()["error"]["code"] == 31
+
+    # Projected listings report the stored version too
+    meta_cache.clear()
+    query = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": subpath,
+        "filter_shortnames": [shortname],
+        "filter_types": ["content"],
+        "include_fields": ["body"],
+    }
+    response = client.post("/managed/query", json=query, headers=headers)
+    assert response.json()["records"][0]["attributes"]["version"] == version + 1
+
+
+def test_request_atomic_rollback():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/request"
+    record = {
+        "resource_type": "content",
+        "subpath": subpath,
+        "shortname": shortname,
+        "attributes": {"body": "4 doors"},
+    }
+    request_data = {
+        "space_name": PRODUCTS_SPACE,
+        "request_type": "update",
+        "atomic": True,
+        "records": [record, {**record, "shortname": "missing"}],
+    }
+    meta_file = f"{dirpath}/meta.content.json"
+    with open(meta_file) as file:
+        meta_before = file.read()
+
+    response = client.post(endpoint, json=request_data, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    results = response.json()["attributes"]["results"]
+    assert [one["error"]["code"] for one in results] == [204, 30]
+    with open(meta_file) as file:
+        assert file.read() == meta_before
+    assert not os.listdir(journal.journals_path(PRODUCTS_SPACE))
+
+    # A rolled back create drops the payload doc queued under its schema
+    schema_file = settings.spaces_folder / PRODUCTS_SPACE / "schema" / "rollback.json"
+    schema_file.parent.mkdir(exist_ok=True)
+    schema_file.write_text(json.dumps({"type": "object", "properties": {}}))
+    try:
+        created = {
+            **record,
+            "shortname": "schemed",
+            "attributes": {"schema_shortname": "rollback", "body": "4 doors"},
+        }
+        invalid = {
+            **record,
+            "shortname": "invalid",
+            "attributes": {"schema_shortname": "missing", "body": "4 doors"},
+        }
+        response = client.post(
+            endpoint,
+            json={
+                **request_data,
+                "request_type": "create",
+                "records": [created, invalid],
+            },
+            headers=headers,
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["status"] == "failed"
+        assert not os.path.exists(
+            settings.spaces_folder / PRODUCTS_SPACE / subpath / "schemed.json"
+        )
+        for schema_name in ("meta", "rollback"):
+            docid = f"{PRODUCTS_SPACE}:{schema_name}:{subpath}/schemed"
+            assert indexer._pending[docid][0] is None
+    finally:
+        schema_file.unlink()
+
+
+def test_upload_deduplicated_payload():
+    settings.content_addressed_payloads = True
+    payload_path = (
+        settings.spaces_folder
+        / PRODUCTS_SPACE
+        / subpath
+        / ".dm"
+        / shortname
+        / "attachments.media"
+        / "mypicture.jpeg"
+    )
+    try:
+        inodes = []
+        for _ in range(2):
+            test_upload_attachment_with_payload()
+            inodes.append(os.stat(payload_path).st_ino)
+        assert inodes[0] == inodes[1]
+        assert os.stat(payload_path).st_nlink == 2
+        test_retrieve_attachment()
+
+        # Replacing the payload releases the blob of the previous content
+        with open(attachment_payload_path, "rb") as file:
+            previous = blobs.blob_path(
+                PRODUCTS_SPACE, hashlib.sha1(file.read()).hexdigest()
+            )
+        with open(attachment_record_path, "rb") as request_file:
+            data = [
+                ("request_record", ("record.json", request_file, "application/json")),
+                ("payload_file", ("logo.jpeg", b"other picture", "image/jpeg")),
+            ]
+            assert_code_and_status_success(
+                client.post(
+                    "managed/resource_with_payload",
+                    data={"space_name": PRODUCTS_SPACE},
+                    files=data,
+                )
+            )
+        assert not previous.exists()
+        assert os.stat(payload_path).st_nlink == 2
+
+        # Json payloads keep their checksum, and are released with their meta
+        request_data = {
+            "space_name": PRODUCTS_SPACE,
+            "request_type": "create",
+            "records": [
+                {
+                    "resource_type": "content",
+                    "subpath": subpath,
+                    "shortname": "blobbed",
+                    "attributes": {"body": "stored once"},
+                }
+            ],
+        }
+        assert_code_and_status_success(
+            client.post("/managed/request", json=request_data)
+        )
+        with open(
+            settings.spaces_folder
+            / PRODUCTS_SPACE
+            / subpath
+            / ".dm/blobbed/meta.content.json"
+        ) as file:
+            checksum = json.load(file)["payload"]["checksum"]
+        blob = blobs.blob_path(PRODUCTS_SPACE, checksum)
+        assert os.stat(blob).st_nlink == 2
+        assert_code_and_status_success(
+            client.post(
+                "/managed/request", json={**request_data, "request_type": "delete"}
+            )
+        )
+        assert not blob.exists()
+    finally:
+        settings.content_addressed_payloads = False
+        shutil.rmtree(blobs.blobs_path(PRODUCTS_SPACE), ignore_errors=True)
+
+
+def test_import_resources_from_csv():
+    schema_file = settings.spaces_folder / PRODUCTS_SPACE / "schema" / "csvtest.json"
+    schema_file.parent.mkdir(exist_ok=True)
+    nested = {"type": "integer"}
+    for key in ("d", "c", "b"):
+        nested = {"type": "object", "properties": {key: nested}}
+    schema_file.write_text(
+        json.dumps(
+            {
+                "type": "object",
+                "properties": {
+                    "price": {"type": "number"},
+                    "labels": {"type": "array"},
+                    "a": nested,
+                },
+            }
+        )
+    )
+    endpoint = f"/managed/resources_from_csv/content/{PRODUCTS_SPACE}/csvtest/csvtest"
+    try:
+        rows = (
+            "shortname,price,a.b.c.d,labels\r\n"
+            'first,10.5,4,"[""new""]"\r\n'
+            "second,oops,5,[]\r\n"
+            "third,1,6,5\r\n"
+            ",2,7,[]\r\n"
+        )
+        response = client.post(
+            endpoint, files={"resources_file": ("data.csv", rows.encode(), "text/csv")}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        json_response = response.json()
+        assert json_response["status"] == "failed"
+        assert json_response["attributes"] == {"total": 4, "imported": 1, "failed": 3}
+        assert json_response["error"]["code"] == 233
+        assert [
+            (failure["row"], failure["shortname"])
+            for failure in json_response["error"]["message"]
+        ] == [(2, "second"), (3, "third"), (4, "")]
+        with open(settings.spaces_folder / PRODUCTS_SPACE / "csvtest/first.json") as file:
+            assert json.load(file) == {
+                "price": 10.5,
+                "a": {"b": {"c": {"d": 4}}},
+                "labels": ["new"],
+            }
+
+        rows = "shortname,missing\r\nthird,1\r\n"
+        response = client.post(
+            endpoint, files={"resources_file": ("data.csv", rows.encode(), "text/csv")}
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["error"]["code"] == 232
+    finally:
+        schema_file.unlink()
+        shutil.rmtree(settings.spaces_folder / PRODUCTS_SPACE / "csvtest")
+
+
+def test_move_and_delete_folder_subtree():
+    headers = {"Content-Type": "application/json"}
+    endpoint = "/managed/request"
+    tree = f"{subpath}/tree"
+    for record in [
+        {"resource_type": "folder", "subpath": subpath, "shortname": "tree"},
+        {"resource_type": "content", "subpath": tree, "shortname": "leaf"},
+    ]:
+        request_data = {
+            "space_name": PRODUCTS_SPACE,
+            "request_type": "create",
+            "records": [{**record, "attributes": {"body": "leaf"}}],
+        }
+        assert_code_and_status_success(
+            client.post(endpoint, json=request_data, headers=headers)
+        )
+
+    request_data = {
+        "space_name": PRODUCTS_SPACE,
+        "request_type": "move",
+        "records": [
+            {
+                "resource_type": "folder",
+                "subpath": subpath,
+                "shortname": "tree",
+                "attributes": {
+                    "src_subpath": subpath,
+                    "src_shortname": "tree",
+                    "dest_subpath": subpath,
+                    "dest_shortname": "moved",
+                },
+            }
+        ],
+    }
+    assert_code_and_status_success(
+        client.post(endpoint, json=request_data, headers=headers)
+    )
+    query = {
+        "type": "subpath",
+        "space_name": PRODUCTS_SPACE,
+        "subpath": f"{subpath}/moved",
+        "filter_types": ["content"],
+    }
+    response = client.post("/managed/query", json=query, headers=headers)
+    assert [one["shortname"] for one in response.json()["records"]] == ["leaf"]
+
+    trash = trash_path(PRODUCTS_SPACE)
+    trashed = set(os.listdir(trash)) if trash.is_dir() else set()
+    assert_code_and_status_success(
+        delete_resource(resource="folder", del_subpath=subpath, del_shortname="moved")
+    )
+    assert not (settings.spaces_folder / PRODUCTS_SPACE / subpath / "moved").exists()
+    reclaimer.run_pending()
+    assert set(os.listdir(trash)) <= trashed
+
+
+def test_delete_attachment_payload_only():
+    folder = (
+        settings.spaces_folder
+        / PRODUCTS_SPACE
+        / subpath
+        / ".dm"
+        / shortname
+        / "attachments.media"
+    )
+    record = {
+        "resource_type": "media",
+        "subpath": f"{subpath}/{shortname}",
+        "shortname": "pic2",
+        "attributes": {},
+    }
+    data = [
+        ("request_record", ("record.json", json.dumps(record), "application/json")),
+        ("payload_file", ("logo.jpeg", b"picture", "image/jpeg")),
+    ]
+    assert_code_and_status_success(
+        client.post(
+            "managed/resource_with_payload",
+            data={"space_name": PRODUCTS_SPACE},
+            files=data,
+        )
+    )
+    # An attachment whose name is part of the files of another one
+    request_data = {
+        "space_name": PRODUCTS_SPACE,
+        "request_type": "create",
+        "records": [{**record, "shortname": "pic"}],
+    }
+    assert_code_and_status_success(client.post("/managed/request", json=request_data))
+
+    response = delete_resource(
+        resource="media", del_subpath=f"{subpath}/{shortname}", del_shortname="pic"
+    )
+    assert_code_and_status_success(response=response)
+    assert not (folder / "meta.pic.json").exists()
+    assert (folder / "pic2.jpeg").is_file()
+    assert (folder / "meta.pic2.json").is_file()
+
+    response = delete_resource(
+        resource="media", del_subpath=f"{subpath}/{shortname}", del_shortname="pic2"
+    )
+    assert_code_and_status_success(response=response)
+    assert not (folder / "pic2.jpeg").exists()
+
+
+def test_bulk_keeps_request_order():
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+
+        return run
+
+    async def run_batch():
+        # The first job waits for a key held by another request
+        async with bulk.hold([("other",)]):
+            batch = asyncio.create_task(
+                bulk.execute(
+                    [
+                        ([("other",), ("shared",)], job("first")),
+                        ([("shared",)], job("second")),
+                    ],
+                    4,
+                )
+            )
+            await asyncio.sleep(0.01)
+            assert order == []
+        await batch
+
+    asyncio.run(run_batch())
+    assert order == ["first", "second"]
+
+
+def test_group_commit():
+    writer = durable.GroupCommit(0.05)
+    with tempfile.TemporaryDirectory() as folder:
+        files = [Path(folder) / f"file{index}" for index in range(8)]
+
+        def write(path: Path, data: bytes):
+            fd, tmp = durable.open_temp(path)
+            os.write(fd, data)
+            writer.commit(fd, tmp, path)
+
+        def write_all(path: Path):
+            for version in range(3):
+                write(path, f"{path.name} {version}".encode() * 1000)
+
+        threads = [threading.Thread(target=write_all, args=(one,)) for one in files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = writer.stats()
+        assert stats["writes"] == 3 * len(files)
+        assert stats["batches"] < stats["writes"]
+        for path in files:
+            assert path.read_bytes() == f"{path.name} 2".encode() * 1000
+        assert sorted(os.listdir(folder)) == sorted(one.name for one in files)
+
+        # A failed rename leaves neither the file nor its temporary file
+        fd, tmp = durable.open_temp(files[0])
+        try:
+            writer.commit(fd, tmp, Path(folder) / "missing" / "file")
+        except FileNotFoundError:
+            pass
+        else:
+            assert False, "the rename should fail"
+        assert sorted(os.listdir(folder)) == sorted(one.name for one in files)
+
+
+def crawl_search(indices: dict[str, list[int]], limit: int, offset: int = 0):
+    """Pages of a search sorted by price over stubbed schema indices"""
+
+    async def search(space_name, schema_name, limit, offset, after=None, **kwargs):
+        docs = [
+            {"shortname": f"{schema_name}{index}", "price": price}
+            for index, price in enumerate(indices[schema_name])
+        ]
+        if after and "v" in after:
+            docs = [doc for doc in docs if doc["price"] >= after["v"]]
+            offset = after["n"]
+        elif after:
+            offset = after["o"]
+        page = docs[offset : offset + limit]
+        return len(docs), [
+            SimpleNamespace(id=doc["shortname"], json=json.dumps(doc)) for doc in page
+        ]
+
+    redis_search, is_numeric = db.redis_search, db.index_registry.is_numeric
+    db.redis_search = search
+    db.index_registry.is_numeric = lambda index_name, field: True
+    pages = []
+    try:
+        query = {
+            "type": "search",
+            "space_name": PRODUCTS_SPACE,
+            "subpath": "/",
+            "search": "",
+            "filter_schema_names": list(indices),
+            "sort_by": "price",
+            "limit": limit,
+            "offset": offset,
+        }
+        while True:
+            total, hits, position = asyncio.run(db.search_page(api.Query(**query)))
+            pages.append((total, [doc["shortname"] for _, doc in hits]))
+            if not position:
+                return pages
+            query["after"] = db.encode_cursor(position)
+    finally:
+        db.redis_search, db.index_registry.is_numeric = redis_search, is_numeric
+
+
+def test_search_page():
+    indices = {
+        "first": [1, 2, 2, 2, 3, 5, 5, 7, 8, 8, 8, 9, 9],
+        "second": [2, 2, 4, 5, 5, 5, 6, 9, 9],
+    }
+    # Ties are merged stream by stream, in the order of the schema names
+    expected = [
+        f"{name}{index}"
+        for _, _, index, name in sorted(
+            (price, order, index, name)
+            for order, (name, prices) in enumerate(indices.items())
+            for index, price in enumerate(prices)
+        )
+    ]
+    for limit, offset in ((4, 0), (3, 0), (4, 3), (5, 7)):
+        pages = crawl_search(indices, limit, offset)
+        shortnames = [shortname for _, page in pages for shortname in page]
+        assert shortnames == expected[offset:]
+        assert all(total == len(expected) for total, _ in pages)
+
+    # A single index skips the offset itself, ties straddle the pages
+    pages = crawl_search({"first": indices["first"]}, 2, 2)
+    assert [shortname for _, page in pages for shortname in page] == [
+        f"first{index}" for index in range(2, 13)
+    ]
+    assert all(total == 13 for total, _ in pages)
+
+    # An index running out of hits mid crawl drops out of the cursor
+    pages = crawl_search({"first": indices["first"], "few": [2, 3]}, 3)
+    shortnames = [shortname for _, page in pages for shortname in page]
+    assert len(shortnames) == len(set(shortnames)) == 15
+    assert shortnames.index("few1") < shortnames.index("first5")
+    assert all(total == 15 for total, _ in pages)
+
+
+def test_schema_cache():
+    schema_file = settings.spaces_folder / PRODUCTS_SPACE / "schema" / "cachetest.json"
+    schema_file.parent.mkdir(exist_ok=True)
+    schema_file.write_text(json.dumps({"type": "object"}))
+    meta = core.Schema(shortname="cachetest", owner_shortname=user_shortname)
+    try:
+        compiled = schema_cache.compiled
+        validator = schema_cache.get(PRODUCTS_SPACE, "cachetest")
+        assert schema_cache.get(PRODUCTS_SPACE, "cachetest") is validator
+        assert schema_cache.compiled == compiled + 1
+
+        # A changed schema file is compiled again
+        schema_file.write_text(json.dumps({"type": "object", "required": ["a"]}))
+        validator = schema_cache.get(PRODUCTS_SPACE, "cachetest")
+        assert validator.schema["required"] == ["a"]
+        assert schema_cache.compiled == compiled + 2
+
+        # So is a schema whose meta was written
+        db.write_meta(PRODUCTS_SPACE, "schema", meta)
+        assert schema_cache.get(PRODUCTS_SPACE, "cachetest") is not validator
+        assert schema_cache.compiled == compiled + 3
+    finally:
+        db.delete_files(PRODUCTS_SPACE, "schema", meta)
+        schema_file.unlink()
+
+
 def test_delete_all():
     # DELETE USER
     response = delete_user()
@@ -237,6 +985,7 @@ def test_delete_all():
     path = settings.spaces_folder / PRODUCTS_SPACE / subpath
     if path.is_dir():
         shutil.rmtree(path)
+    reclaimer.run_pending()
 
 
 def delete_user():
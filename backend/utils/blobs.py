@@ -0,0 +1,115 @@
+""" Content-addressed payload store of a space
+
+Payload files are hard links to a blob kept under
+`<space>/.dm/.blobs/<checksum[:2]>/<checksum>`. Identical payloads share the
+same inode, so storing a duplicate only creates a link, and the usual payload
+paths (and the routes serving them) keep working unchanged. The link count of
+a blob is its reference count: a blob whose only remaining link is its own
+entry in the store is no longer used by any meta and can be reclaimed.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from uuid import uuid4
+from utils.settings import settings
+
+BLOBS_FOLDER = ".blobs"
+
+
+def blobs_path(space_name: str) -> Path:
+    return settings.spaces_folder / space_name / ".dm" / BLOBS_FOLDER
+
+
+def blob_path(space_name: str, checksum: str) -> Path:
+    return blobs_path(space_name) / checksum[:2] / checksum
+
+
+def link_temp(space_name: str, checksum: str, path: Path) -> Path | None:
+    """Link the blob to a temporary name next to path, to be renamed over it
+
+    The link holds a reference, so the blob cannot be reclaimed in between.
+    Return None if there is no blob with that checksum.
+    """
+    tmp = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+    try:
+        os.link(blob_path(space_name, checksum), tmp)
+    except FileNotFoundError:
+        return None
+    return tmp
+
+
+def replace(tmp: Path, path: Path):
+    """Rename a link made by link_temp over path"""
+    os.replace(tmp, path)
+    # rename() is a no-op when both names already link to the same blob
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+
+
+def adopt(space_name: str, checksum: str, path: Path):
+    """Register the freshly written payload file as the blob of its checksum"""
+    blob = blob_path(space_name, checksum)
+    os.makedirs(blob.parent, exist_ok=True)
+    try:
+        os.link(path, blob)
+    except FileExistsError:
+        # Another writer stored the same content first
+        pass
+
+
+def release(space_name: str, checksum: str):
+    """Remove the blob if no payload file links to it anymore"""
+    blob = blob_path(space_name, checksum)
+    try:
+        if os.stat(blob).st_nlink == 1:
+            os.unlink(blob)
+    except FileNotFoundError:
+        pass
+
+
+def open_previous(path: Path) -> int | None:
+    """Open the payload file about to be replaced, for release_previous"""
+    try:
+        return os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+
+
+def release_previous(space_name: str, fd: int | None):
+    """Remove the blob of a replaced payload if nothing links to it anymore
+
+    A replaced payload with a single link left is only linked by its blob,
+    which is found by hashing the content. Close the descriptor either way.
+    """
+    if fd is None:
+        return
+    try:
+        stat = os.fstat(fd)
+        if stat.st_nlink != 1:
+            return
+        sha1 = hashlib.sha1()
+        while chunk := os.read(fd, settings.upload_buffer_size):
+            sha1.update(chunk)
+        blob = blob_path(space_name, sha1.hexdigest())
+        try:
+            if os.stat(blob).st_ino == stat.st_ino:
+                os.unlink(blob)
+        except FileNotFoundError:
+            pass
+    finally:
+        os.close(fd)
+
+
+def collect(space_name: str) -> int:
+    """Remove every unreferenced blob of the space, return how many were removed"""
+    removed = 0
+    for dirpath, _, filenames in os.walk(blobs_path(space_name)):
+        for filename in filenames:
+            blob = os.path.join(dirpath, filename)
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+                removed += 1
+    return removed
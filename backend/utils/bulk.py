@@ -0,0 +1,178 @@
+""" Concurrent execution of the records of a request
+
+Records of a batch are independent unless they touch the same path: each job
+declares the paths it reads or writes and holds a lock on every one of them
+while running, so jobs on distinct paths run concurrently (up to
+`bulk_parallelism` at a time) while jobs on a shared path keep their order.
+
+Moving or deleting a folder changes its whole subtree at once, so such a job
+also holds the tree key of the folder exclusively, while every job holds the
+tree keys of the folders above its path shared.
+"""
+
+import asyncio
+import collections
+import contextlib
+import weakref
+from typing import Any, Awaitable, Callable, Iterable, MutableMapping, NamedTuple
+
+
+class Shared(NamedTuple):
+    """Key held in shared mode, any number of jobs may hold it together"""
+
+    key: tuple
+
+
+class _Lock:
+    """First come first served lock, held by one job or shared by several"""
+
+    def __init__(self):
+        self._shared = 0
+        self._exclusive = False
+        self._waiters: collections.deque[tuple[bool, asyncio.Future]] = (
+            collections.deque()
+        )
+
+    def _free(self, shared: bool) -> bool:
+        return not self._exclusive and (shared or not self._shared)
+
+    def _take(self, shared: bool):
+        if shared:
+            self._shared += 1
+        else:
+            self._exclusive = True
+
+    def request(self, shared: bool) -> asyncio.Future:
+        """Queue for the lock, the future is done once the lock is granted"""
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._waiters and self._free(shared):
+            self._take(shared)
+            waiter.set_result(None)
+        else:
+            self._waiters.append((shared, waiter))
+        return waiter
+
+    def abandon(self, shared: bool, waiter: asyncio.Future):
+        """Give up a request, releasing the lock if it was already granted"""
+        if waiter.done() and not waiter.cancelled():
+            self.release(shared)
+            return
+        waiter.cancel()
+        if (shared, waiter) in self._waiters:
+            self._waiters.remove((shared, waiter))
+        self._wake()
+
+    def release(self, shared: bool):
+        if shared:
+            self._shared -= 1
+        else:
+            self._exclusive = False
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._free(self._waiters[0][0]):
+            shared, waiter = self._waiters.popleft()
+            if waiter.cancelled():
+                continue
+            self._take(shared)
+            waiter.set_result(None)
+
+
+# Locks are shared by all the requests and dropped once no job holds them
+_locks: weakref.WeakValueDictionary[tuple, _Lock] = weakref.WeakValueDictionary()
+
+
+def path_key(space_name: str, subpath: str, shortname: str) -> tuple[str, str, str]:
+    """Lock key of a resource, "/a/b/" and "a/b" are the same subpath"""
+    return (space_name, subpath.strip("/"), shortname)
+
+
+def tree_key(space_name: str, subpath: str) -> tuple[str, str, str, str]:
+    """Lock key of everything under subpath, never equal to a path_key"""
+    return ("tree", space_name, subpath.strip("/"), "*")
+
+
+def ancestor_keys(space_name: str, subpath: str) -> list[Shared]:
+    """Shared tree keys of subpath and of every folder above it"""
+    parts = [one for one in subpath.strip("/").split("/") if one and one != "."]
+    return [
+        Shared(tree_key(space_name, "/".join(parts[:end])))
+        for end in range(1, len(parts) + 1)
+    ]
+
+
+async def _acquire(
+    table: MutableMapping[tuple, _Lock], keys: Iterable[tuple]
+) -> list[tuple[_Lock, bool]]:
+    # A key wanted both ways is held exclusively
+    modes: dict[tuple, bool] = {}
+    for one in keys:
+        key, shared = (one.key, True) if isinstance(one, Shared) else (one, False)
+        modes[key] = modes.get(key, True) and shared
+
+    # A job queues on all its keys at once, before any other job can, so jobs
+    # are granted every key in the order they asked, and cannot deadlock
+    requests: list[tuple[_Lock, bool, asyncio.Future]] = []
+    for key, shared in modes.items():
+        lock = table.get(key)
+        if lock is None:
+            lock = _Lock()
+            table[key] = lock
+        requests.append((lock, shared, lock.request(shared)))
+    try:
+        for _, _, waiter in requests:
+            await waiter
+    except BaseException:
+        for lock, shared, waiter in reversed(requests):
+            lock.abandon(shared, waiter)
+        raise
+    return [(lock, shared) for lock, shared, _ in requests]
+
+
+def _release(locks: list[tuple[_Lock, bool]]):
+    for lock, shared in reversed(locks):
+        lock.release(shared)
+
+
+@contextlib.asynccontextmanager
+async def hold(keys: Iterable[tuple]):
+    """Keep every key locked for other requests, e.g. for a whole batch"""
+    locks = await _acquire(_locks, keys)
+    try:
+        yield
+    finally:
+        _release(locks)
+
+
+async def _run_locked(
+    table: MutableMapping[tuple, _Lock],
+    keys: Iterable[tuple],
+    job: Callable[[], Awaitable[Any]],
+    semaphore: asyncio.Semaphore,
+) -> Any:
+    locks = await _acquire(table, keys)
+    try:
+        async with semaphore:
+            return await job()
+    finally:
+        _release(locks)
+
+
+async def execute(
+    jobs: list[tuple[Iterable[tuple], Callable[[], Awaitable[Any]]]],
+    parallelism: int,
+    held: bool = False,
+) -> list[BaseException | None]:
+    """Run every (keys, job) and return None or the exception raised, per job
+
+    Jobs are started in order, so those sharing a key run in that order.
+    A failing job does not stop the others. When the caller already holds the
+    keys (see hold), the jobs only order themselves against each other.
+    """
+    table: MutableMapping[tuple, _Lock] = {} if held else _locks
+    semaphore = asyncio.Semaphore(max(parallelism, 1))
+    results = await asyncio.gather(
+        *(_run_locked(table, keys, job, semaphore) for keys, job in jobs),
+        return_exceptions=True,
+    )
+    return [result if isinstance(result, BaseException) else None for result in results]
@@ -0,0 +1,324 @@
+""" Embedded per-space metadata catalog
+
+Each space keeps an SQLite file under its `.dm` folder that mirrors the
+locator columns of every entry and sub folder (shortname, resource_type,
+tags, uuid, timestamps and the payload pointer). Subpath queries are then
+answered with indexed lookups instead of globbing and parsing every meta file.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+import models.api as api
+import models.core as core
+from models.enums import ResourceType
+from utils.settings import settings
+from utils.walker import walk_tree
+
+CATALOG_FILENAME = "catalog.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    subpath TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    shortname TEXT NOT NULL,
+    resource_type TEXT NOT NULL,
+    uuid TEXT,
+    tags TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    payload_content_type TEXT,
+    payload_body TEXT,
+    PRIMARY KEY (subpath, kind, shortname, resource_type)
+);
+CREATE TABLE IF NOT EXISTS entry_tags (
+    subpath TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    shortname TEXT NOT NULL,
+    resource_type TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (subpath, tag, kind, shortname, resource_type)
+);
+"""
+
+_connections: dict[str, sqlite3.Connection] = {}
+_lock = threading.RLock()
+
+
+def catalog_path(space_name: str) -> Path:
+    return settings.spaces_folder / space_name / ".dm" / CATALOG_FILENAME
+
+
+def normalize_subpath(subpath: str) -> str:
+    """Catalog key of a subpath: "/", "" and "." all map to the space root"""
+    subpath = subpath.strip("/")
+    return "" if subpath == "." else subpath
+
+
+def _connection(space_name: str) -> sqlite3.Connection:
+    """Open (and build from disk if missing) the catalog of the space"""
+    with _lock:
+        if space_name in _connections:
+            return _connections[space_name]
+
+        path = catalog_path(space_name)
+        is_new = not path.is_file()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        _connections[space_name] = connection
+        if is_new:
+            _populate(space_name, connection)
+        return connection
+
+
+def _row(kind: str, subpath: str, meta: core.Meta) -> tuple:
+    payload_content_type = None
+    payload_body = None
+    if meta.payload:
+        payload_content_type = meta.payload.content_type
+        if not isinstance(meta.payload.body, dict):
+            payload_body = str(meta.payload.body)
+    return (
+        subpath,
+        kind,
+        meta.shortname,
+        type(meta).__name__.lower(),
+        str(meta.uuid),
+        json.dumps(meta.tags or []),
+        meta.created_at.isoformat(),
+        meta.updated_at.isoformat(),
+        payload_content_type,
+        payload_body,
+    )
+
+
+def _insert(connection: sqlite3.Connection, kind: str, subpath: str, meta: core.Meta):
+    row = _row(kind, subpath, meta)
+    _delete(connection, subpath, kind, row[2], row[3])
+    connection.execute("INSERT INTO entries VALUES (?,?,?,?,?,?,?,?,?,?)", row)
+    connection.executemany(
+        "INSERT OR IGNORE INTO entry_tags VALUES (?,?,?,?,?)",
+        [(subpath, kind, row[2], row[3], tag) for tag in meta.tags or []],
+    )
+
+
+def _delete(
+    connection: sqlite3.Connection,
+    subpath: str,
+    kind: str,
+    shortname: str,
+    resource_type: str,
+):
+    for table in ("entries", "entry_tags"):
+        connection.execute(
+            f"DELETE FROM {table} WHERE subpath = ? AND kind = ? AND shortname = ? AND resource_type = ?",
+            (subpath, kind, shortname, resource_type),
+        )
+
+
+def _kind(meta: core.Meta) -> str | None:
+    """Attachments and spaces are not listed by subpath queries"""
+    if isinstance(meta, (core.Attachment, core.Space)):
+        return None
+    return "folder" if isinstance(meta, core.Folder) else "entry"
+
+
+def _populate(space_name: str, connection: sqlite3.Connection):
+    """Scan the space folder and insert every entry and sub folder"""
+    space_path = settings.spaces_folder / space_name
+    connection.execute("BEGIN")
+    try:
+        for subpath, one in walk_tree(space_path):
+            resource_class = getattr(core, one.resource_type.title())
+            _insert(
+                connection,
+                one.kind,
+                subpath,
+                resource_class.parse_raw(one.path.read_text()),
+            )
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def upsert(space_name: str, subpath: str, meta: core.Meta):
+    """Insert or refresh the catalog row of the given meta"""
+    kind = _kind(meta)
+    if not kind:
+        return
+    connection = _connection(space_name)
+    with _lock:
+        connection.execute("BEGIN")
+        _insert(connection, kind, normalize_subpath(subpath), meta)
+        connection.execute("COMMIT")
+
+
+def remove(space_name: str, subpath: str, meta: core.Meta):
+    """Drop the catalog row of the given meta"""
+    kind = _kind(meta)
+    if not kind:
+        return
+    connection = _connection(space_name)
+    with _lock:
+        connection.execute("BEGIN")
+        _delete(
+            connection,
+            normalize_subpath(subpath),
+            kind,
+            meta.shortname,
+            type(meta).__name__.lower(),
+        )
+        connection.execute("COMMIT")
+
+
+def _subtree_condition(subpath: str) -> tuple[str, list]:
+    return "(subpath = ? OR substr(subpath, 1, ?) = ?)", [
+        subpath,
+        len(subpath) + 1,
+        subpath + "/",
+    ]
+
+
+def remove_subtree(space_name: str, subpath: str):
+    """Drop the rows of every entry and folder under subpath"""
+    subpath = normalize_subpath(subpath)
+    condition, params = _subtree_condition(subpath)
+    connection = _connection(space_name)
+    with _lock:
+        connection.execute("BEGIN")
+        for table in ("entries", "entry_tags"):
+            connection.execute(f"DELETE FROM {table} WHERE {condition}", params)
+        connection.execute("COMMIT")
+
+
+def refresh_subtree(space_name: str, subpath: str):
+    """Replace the rows under subpath with what is on disk, in one transaction"""
+    subpath = normalize_subpath(subpath)
+    condition, params = _subtree_condition(subpath)
+    connection = _connection(space_name)
+    tree = settings.spaces_folder / space_name / subpath
+    with _lock:
+        connection.execute("BEGIN")
+        try:
+            for table in ("entries", "entry_tags"):
+                connection.execute(f"DELETE FROM {table} WHERE {condition}", params)
+            for relative, one in walk_tree(tree):
+                resource_class = getattr(core, one.resource_type.title())
+                _insert(
+                    connection,
+                    one.kind,
+                    "/".join(part for part in (subpath, relative) if part),
+                    resource_class.parse_raw(one.path.read_text()),
+                )
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+
+def move_subtree(space_name: str, src_subpath: str, dest_subpath: str):
+    """Rewrite the subpath of every row under src_subpath to dest_subpath"""
+    src_subpath = normalize_subpath(src_subpath)
+    dest_subpath = normalize_subpath(dest_subpath)
+    condition, params = _subtree_condition(src_subpath)
+    connection = _connection(space_name)
+    with _lock:
+        connection.execute("BEGIN")
+        for table in ("entries", "entry_tags"):
+            connection.execute(
+                f"UPDATE {table} SET subpath = ? || substr(subpath, ?)"
+                f" WHERE {condition}",
+                [dest_subpath, len(src_subpath) + 1] + params,
+            )
+        connection.execute("COMMIT")
+
+
+def reset(space_name: str):
+    """Close and remove the catalog file, it is rebuilt on next use"""
+    with _lock:
+        connection = _connections.pop(space_name, None)
+        if connection:
+            connection.close()
+        for suffix in ("", "-wal", "-shm"):
+            path = catalog_path(space_name).with_name(CATALOG_FILENAME + suffix)
+            if path.is_file():
+                os.remove(path)
+
+
+def rebuild(space_name: str):
+    """Drop the catalog and rebuild it from the files on disk"""
+    reset(space_name)
+    _connection(space_name)
+
+
+def query(
+    query: api.Query,
+    after: tuple[str, str, str] | None = None,
+    fetch: int | None = None,
+) -> tuple[int, list[tuple[str, str, str]]]:
+    """Given a subpath query return the total and the matching catalog rows
+
+    Parameters
+    ----------
+    query: api.Query
+        Query of type subpath
+    after: (kind, shortname, resource_type) | None
+        Position of the last row of the previous page, replaces the offset
+    fetch: int | None
+        Number of rows to return, defaults to limit + 1
+
+    Returns
+    -------
+    Total, up to fetch (kind, shortname, resource_type) rows, entries first
+
+    """
+    conditions: list[str] = []
+    params: list = [normalize_subpath(query.subpath)]
+
+    entry_conditions = ["kind = 'entry'"]
+    if query.filter_types:
+        entry_conditions.append(
+            f"resource_type IN ({','.join('?' * len(query.filter_types))})"
+        )
+        params.extend(ResourceType(one).value for one in query.filter_types)
+    if query.filter_tags:
+        entry_conditions.append(
+            "EXISTS (SELECT 1 FROM entry_tags t WHERE t.subpath = e.subpath"
+            " AND t.kind = e.kind AND t.shortname = e.shortname"
+            " AND t.resource_type = e.resource_type"
+            f" AND t.tag IN ({','.join('?' * len(query.filter_tags))}))"
+        )
+        params.extend(query.filter_tags)
+    # Sub folders are only filtered by shortname, as in the filesystem scan
+    conditions.append(f"(({' AND '.join(entry_conditions)}) OR kind = 'folder')")
+
+    if query.filter_shortnames:
+        conditions.append(
+            f"shortname IN ({','.join('?' * len(query.filter_shortnames))})"
+        )
+        params.extend(query.filter_shortnames)
+
+    where = "subpath = ? AND " + " AND ".join(conditions)
+    page_where, page_params, offset = where, params, query.offset
+    if after:
+        page_where += " AND (kind, shortname, resource_type) > (?, ?, ?)"
+        page_params, offset = params + list(after), 0
+
+    connection = _connection(query.space_name)
+    with _lock:
+        total = connection.execute(
+            f"SELECT COUNT(*) FROM entries e WHERE {where}", params
+        ).fetchone()[0]
+        rows = connection.execute(
+            f"SELECT kind, shortname, resource_type FROM entries e WHERE {page_where}"
+            " ORDER BY kind, shortname, resource_type LIMIT ? OFFSET ?",
+            page_params + [fetch or query.limit + 1, offset],
+        ).fetchall()
+    return total, rows
@@ -0,0 +1,91 @@
+""" Column plans for importing resources from a CSV file
+
+The header is compiled once against the JSON schema into one plan per column:
+where the value goes in the payload (at any nesting depth) and how the cell
+is coerced to the schema type. Rows are then converted without looking at
+the schema again.
+"""
+
+import json
+from itertools import islice
+from typing import Any, Callable, Iterator, NamedTuple
+
+
+def _number(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    return lambda value: parse((value or "0").replace(",", ""))
+
+
+def _array(value: str) -> list[str]:
+    items = json.loads(value or "[]")
+    if not isinstance(items, list):
+        raise ValueError(f"expected a json array, got {value}")
+    return [str(item) for item in items]
+
+
+COERCERS: dict[str, Callable[[str], Any]] = {
+    "string": lambda value: value or "null",
+    "integer": _number(int),
+    "number": _number(float),
+    "array": _array,
+}
+
+
+class ColumnPlan(NamedTuple):
+    index: int
+    column: str
+    keys: tuple[str, ...]  # path of the value in the payload
+    coerce: Callable[[str], Any]
+
+
+class PlanError(Exception):
+    pass
+
+
+def compile_plan(
+    header: list[str], schema: dict
+) -> tuple[int | None, list[ColumnPlan]]:
+    """Index of the shortname column and the plans of the payload columns"""
+    shortname_index = None
+    plans: list[ColumnPlan] = []
+    for index, column in enumerate(header):
+        if not column:
+            continue
+        if column == "shortname":
+            shortname_index = index
+            continue
+
+        keys = tuple(key.strip() for key in column.split("."))
+        schema_property = schema
+        for key in keys:
+            properties = schema_property.get("properties", {})
+            if key not in properties:
+                raise PlanError(f"column {column} is not defined by the schema")
+            schema_property = properties[key]
+
+        property_type = schema_property.get("type")
+        if property_type not in COERCERS:
+            raise PlanError(f"column {column} has unsupported type {property_type}")
+        plans.append(ColumnPlan(index, column, keys, COERCERS[property_type]))
+    return shortname_index, plans
+
+
+def row_payload(plans: list[ColumnPlan], row: list[str]) -> dict[str, Any]:
+    """Payload of a row, raise ValueError naming the column that failed"""
+    payload: dict[str, Any] = {}
+    for plan in plans:
+        value = row[plan.index] if plan.index < len(row) else ""
+        try:
+            value = plan.coerce(value)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"{plan.column}: {e}")
+        target = payload
+        for key in plan.keys[:-1]:
+            target = target.setdefault(key, {})
+        target[plan.keys[-1]] = value
+    return payload
+
+
+def read_chunk(reader: Iterator[list[str]], size: int) -> list[list[str]]:
+    """Next rows of the csv reader, an empty list at the end of the file"""
+    return list(islice(reader, size))
+
@@ -1,25 +1,57 @@
 import sys
+import asyncio
+import base64
+import hashlib
+import bisect
+import collections
+import heapq
+import itertools
 from models.enums import ContentType, ResourceType
 from utils.settings import settings
 import models.core as core
-from typing import Any, TypeVar, Type
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Iterable,
+    NamedTuple,
+    TypeVar,
+    Type,
+)
 import models.api as api
 import utils.regex as regex
+import utils.catalog as catalog
+import utils.fs as fs
+import utils.durable as durable
+import utils.blobs as blobs
+from utils.meta_cache import meta_cache
+from utils.space_registry import space_registry
+from utils.schema_cache import schema_cache
+from utils.indexer import index_meta, unindex_meta, unindex_payload
+from utils.reclaimer import reclaimer, join_subpath, move_to_trash
+from utils.walker import Entry, walk_subpath, walk_attachments
 import os
 import re
 import json
+import orjson
 from pathlib import Path
 from utils.logger import logger
-from utils.redis_services import search as redis_search, get_doc_by_id
+from utils.redis_services import search as redis_search, get_docs_by_ids, index_registry
 from fastapi import status
-import aiofiles
 
 MetaChild = TypeVar("MetaChild", bound=core.Meta)
 
-FILE_PATTERN = re.compile("\\.dm\\/([a-zA-Z0-9_]*)\\/meta\\.([a-zA-z]*)\\.json$")
-ATTACHMENT_PATTERN = re.compile(r"attachments.(\w*)\/meta\.(\w*)\.json$")
-FOLDER_PATTERN = re.compile("\\/([a-zA-Z0-9_]*)\\/.dm\\/meta.folder.json$")
-SPACES_PATTERN = re.compile("\\/([a-zA-Z0-9_]*)\\/.dm\\/meta.space.json$")
+# Meta fields Meta.to_record always reads, whatever the include_fields
+PROJECTION_FIELDS = {
+    "uuid",
+    "shortname",
+    "displayname",
+    "description",
+    "payload",
+    "tags",
+    "version",
+}
 
 
 def locators_query(query: api.Query) -> tuple[int, list[core.Locator]]:
@@ -43,128 +75,479 @@ def locators_query(query: api.Query) -> tuple[int, list[core.Locator]]:
             if query.include_fields is None:
                 query.include_fields = []
 
-            # Gel all matching entries
-            entries_glob = ".dm/*/meta.*.json"
-            for one in path.glob(entries_glob):
-                match = FILE_PATTERN.search(str(one))
-                if not match or not one.is_file:
-                    logger.error("Invalid file pattern")
-                    continue
-                shortname = match.group(1)
-                resource_name = match.group(2).lower()
+            for one in walk_subpath(path):
                 if (
-                    query.filter_types
-                    and not ResourceType(resource_name) in query.filter_types
+                    one.kind == "entry"
+                    and query.filter_types
+                    and not ResourceType(one.resource_type) in query.filter_types
                 ):
                     logger.info(
-                        resource_name + " resource is not listed in filter types"
+                        one.resource_type + " resource is not listed in filter types"
                     )
                     continue
 
-                if query.filter_shortnames and shortname not in query.filter_shortnames:
+                if (
+                    query.filter_shortnames
+                    and one.shortname not in query.filter_shortnames
+                ):
                     continue
 
                 total += 1
-                if len(locators) >= query.limit or total < query.offset:
+                if len(locators) >= query.limit or total <= query.offset:
                     continue
                 resource_class = getattr(
-                    sys.modules["models.core"], resource_name.title()
+                    sys.modules["models.core"], one.resource_type.title()
                 )
-                meta = resource_class.parse_raw(one.read_text())
+                meta = meta_cache.get(one.path, resource_class)
                 locators.append(
                     core.Locator(
                         uuid=meta.uuid,
                         space_name=query.space_name,
                         subpath=query.subpath,
-                        shortname=shortname,
-                        type=ResourceType(resource_name),
-                    )
-                )
-            # Get all matching sub folders
-            subfolders_glob = "*/.dm/meta.folder.json"
-            for one in path.glob(subfolders_glob):
-                match = FOLDER_PATTERN.search(str(one))
-
-                if not match or not one.is_file:
-                    logger.error("Invalid file pattern")
-                    continue
-                shortname = match.group(1)
-                if query.filter_shortnames and shortname not in query.filter_shortnames:
-                    continue
-                total += 1
-                if len(locators) >= query.limit or total < query.offset:
-                    continue
-                meta = core.Folder.parse_raw(one.read_text())
-                locators.append(
-                    core.Locator(
-                        uuid=meta.uuid,
-                        space_name=query.space_name,
-                        subpath=query.subpath,
-                        shortname=shortname,
-                        type=core.ResourceType.locator,
+                        shortname=one.shortname,
+                        type=ResourceType(one.resource_type)
+                        if one.kind == "entry"
+                        else core.ResourceType.locator,
                     )
                 )
     return total, locators
 
 
-async def serve_query(query: api.Query) -> tuple[int, list[core.Record]]:
-    """Given a query return the total and the records
+def encode_cursor(position: dict[str, Any]) -> str:
+    """Opaque cursor handed to clients in the response attributes"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(
+    cursor: str, valid: Callable[[dict[str, Any]], bool]
+) -> dict[str, Any]:
+    """Decode a cursor made by encode_cursor, rejecting positions not valid"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(position, dict) and valid(position):
+            return position
+    except (ValueError, UnicodeDecodeError):
+        pass
+    raise api.Exception(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        error=api.Error(type="query", code=13, message="invalid cursor"),
+    )
+
+
+def is_count(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def valid_subpath_cursor(position: dict[str, Any]) -> bool:
+    """{"p": last (kind, shortname, resource_type) row}"""
+    row = position.get("p")
+    return (
+        isinstance(row, list)
+        and len(row) == 3
+        and all(isinstance(one, str) for one in row)
+    )
+
+
+def valid_search_cursor(position: dict[str, Any]) -> bool:
+    """{"t": total, "i": position of each schema index with more hits}"""
+    indices = position.get("i")
+    if not is_count(position.get("t")) or not isinstance(indices, dict):
+        return False
+    for one in indices.values():
+        if not isinstance(one, dict):
+            return False
+        if "v" in one:
+            value = one["v"]
+            if (
+                not isinstance(value, (int, float))
+                or isinstance(value, bool)
+                or not is_count(one.get("n"))
+            ):
+                return False
+        elif not is_count(one.get("o")):
+            return False
+    return True
+
+
+def search_cursor(
+    query: api.Query,
+    schema_name: str,
+    previous: dict[str, Any] | None,
+    start: int,
+    docs: list[dict],
+) -> dict[str, Any]:
+    """Position of one schema index after the docs taken from it for a page
+
+    Sorting on a numeric field of the index resumes with a range filter on the
+    last returned value, skipping the rows already returned with that same
+    value. Any other ordering resumes from an offset (start on the first page).
+    So does a crawl that started past an offset: the rows tied with the last
+    value may sit in the skipped prefix, where they cannot be counted.
+    """
+    if not docs:
+        return previous or {"o": start}
+    index_name = f"{query.space_name}:{schema_name}"
+    by_value = "v" in previous if previous else start == 0
+    if (
+        by_value
+        and query.sort_by
+        and index_registry.is_numeric(index_name, query.sort_by)
+    ):
+        values = [one.get(query.sort_by) for one in docs]
+        last = values[-1]
+        ties = sum(1 for value in values if value == last)
+        if previous and previous.get("v") == last:
+            ties += previous["n"]
+        return {"v": last, "n": ties}
+    previous_offset = previous["o"] if previous and "o" in previous else start
+    return {"o": previous_offset + len(docs)}
+
+
+def search_sort_key(sort_by: str | None) -> Callable[[tuple], Any] | None:
+    """Merge key of (schema index, doc id, doc) hits, in redis' ascending order
+
+    Missing values go last, and strings after numbers so that schemas typing
+    the field differently still merge
+    """
+    if not sort_by:
+        return None
+
+    def key(hit: tuple) -> tuple:
+        value = hit[2].get(sort_by)
+        return (value is None, isinstance(value, str), value)
+
+    return key
+
+
+async def search_page(
+    query: api.Query,
+) -> tuple[int, list[tuple[str, dict]], dict[str, Any]]:
+    """Search every schema index concurrently and merge their hits into a page
+
+    Each index returns its next `limit` hits in the requested order (or all
+    its hits up to `offset + limit` on a first page over several indices), the
+    sorted streams are merged and the page is taken from the merge. Return the
+    combined total, the (doc id, doc) hits of the page and the position of the
+    next page: the total of the first page (later pages resume with a range
+    filter, their counts miss the hits before it) and the cursors of the
+    indices that still have hits.
+    """
+    position = decode_cursor(query.after, valid_search_cursor) if query.after else {}
+    cursors = position.get("i", {})
+    # Schemas missing from the cursor were exhausted on previous pages
+    schema_names = [
+        one for one in query.filter_schema_names if not query.after or one in cursors
+    ]
+    # A single index can skip the offset itself
+    start = query.offset if len(schema_names) == 1 else 0
+    fetch = query.limit if query.after else query.offset - start + query.limit
+    results = await asyncio.gather(
+        *(
+            redis_search(
+                space_name=query.space_name,
+                schema_name=schema_name,
+                search=query.search,
+                filters={
+                    "resource_type": query.filter_types,
+                    "shortname": query.filter_shortnames,
+                    "tags": query.filter_tags,
+                    "subpath": [query.subpath] if query.subpath != "/" else [],
+                },
+                limit=fetch,
+                offset=start,
+                sort_by=query.sort_by,
+                after=cursors.get(schema_name),
+            )
+            for schema_name in schema_names
+        )
+    )
+
+    total = (
+        position["t"]
+        if query.after
+        else sum(schema_total for schema_total, _ in results)
+    )
+    streams = [
+        [(schema_name, one.id, orjson.loads(one.json)) for one in docs]
+        for schema_name, (_, docs) in zip(schema_names, results)
+    ]
+    skip = 0 if query.after else query.offset - start
+    merged = list(
+        heapq.merge(*streams, key=search_sort_key(query.sort_by))
+        if query.sort_by
+        else itertools.chain(*streams)
+    )[: skip + query.limit]
+
+    next_cursors: dict[str, Any] = {}
+    for schema_name, stream in zip(schema_names, streams):
+        taken = [doc for name, _, doc in merged if name == schema_name]
+        # An index has more hits if it filled its fetch or some were not taken
+        if stream and (len(stream) == fetch or len(taken) < len(stream)):
+            next_cursors[schema_name] = search_cursor(
+                query, schema_name, cursors.get(schema_name), start, taken
+            )
+    next_position = {"t": total, "i": next_cursors} if next_cursors else {}
+    return total, [(docid, doc) for _, docid, doc in merged[skip:]], next_position
+
+
+def space_records(query: api.Query) -> list[core.Record]:
+    return [
+        space.to_record(
+            query.subpath,
+            shortname,
+            query.include_fields if query.include_fields else [],
+            query.exclude_fields,
+        )
+        for shortname, space in space_registry.refresh().items()
+    ]
+
+
+def subpath_rows(query: api.Query, path: Path) -> list[tuple[str, str, str]]:
+    """Scan the subpath folder and return the sorted (kind, shortname, resource_type)
+    of every matching entry and sub folder, entries first
+
+    Meta files are only parsed when filtering by tags
+    """
+    entries: list[tuple[str, str, str]] = []
+    folders: list[tuple[str, str, str]] = []
+    for one in walk_subpath(path):
+        if query.filter_shortnames and one.shortname not in query.filter_shortnames:
+            continue
+
+        if one.kind == "folder":
+            folders.append((one.kind, one.shortname, one.resource_type))
+            continue
+
+        if (
+            query.filter_types
+            and not ResourceType(one.resource_type) in query.filter_types
+        ):
+            logger.info(one.resource_type + " resource is not listed in filter types")
+            continue
+
+        if query.filter_tags:
+            resource_class = getattr(
+                sys.modules["models.core"], one.resource_type.title()
+            )
+            resource_obj = meta_cache.get(one.path, resource_class)
+            if not resource_obj.tags or not any(
+                item in resource_obj.tags for item in query.filter_tags
+            ):
+                continue
+        entries.append((one.kind, one.shortname, one.resource_type))
+
+    return sorted(entries) + sorted(folders)
+
+
+def listed_meta(
+    path: Path, class_type: Type[MetaChild], query: api.Query
+) -> MetaChild:
+    """Meta of a listed entry, only decoding the projected fields when the
+    query asks for a subset through include_fields"""
+    if query.include_fields:
+        return meta_cache.get_projection(
+            path, class_type, PROJECTION_FIELDS | set(query.include_fields)
+        )
+    return meta_cache.get(path, class_type)
+
+
+def read_json_payload(path: Path) -> Any:
+    """Parse a json payload file, None if it does not exist"""
+    try:
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
+        return None
+
+
+def prefetch_rows(path: Path, rows: list[tuple[str, str, str]]):
+    """Warm the meta cache with the entries of the next page, and ask the
+    kernel to read ahead their json payload files"""
+    for kind, shortname, resource_name in rows:
+        if kind != "entry":
+            continue
+        try:
+            meta = meta_cache.get(
+                path / ".dm" / shortname / f"meta.{resource_name}.json",
+                getattr(sys.modules["models.core"], resource_name.title()),
+            )
+            if (
+                not meta.payload
+                or meta.payload.content_type != ContentType.json
+                or not hasattr(os, "posix_fadvise")
+            ):
+                continue
+            fd = os.open(path / str(meta.payload.body), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except (OSError, ValueError):
+            continue
+
+
+def attachment_entries(query: api.Query, path: Path, shortname: str) -> list[Entry]:
+    """Attachment meta files of the entry found under path, by filter types"""
+    entries: list[Entry] = []
+    for one in walk_attachments(path / ".dm" / shortname):
+        if (
+            query.filter_types
+            and not ResourceType(one.resource_type) in query.filter_types
+        ):
+            logger.info(one.resource_type + " resource is not listed in filter types")
+            continue
+        entries.append(one)
+    return entries
+
+
+async def attachment_records(
+    query: api.Query, path: Path, shortname: str
+) -> dict[ResourceType, list[Any] | int]:
+    """Attachments of the entry found under path, as per query.attachments_mode
+
+    counts only lists the attachment folders, full reads every attachment meta
+    concurrently on the filesystem pool
+    """
+    entries = await fs.run("query", attachment_entries, query, path, shortname)
+    if query.attachments_mode == api.AttachmentsMode.counts:
+        counts: dict[ResourceType, list[Any] | int] = {}
+        for one in entries:
+            counts[one.resource_type] = counts.get(one.resource_type, 0) + 1
+        return counts
+
+    metas = await asyncio.gather(
+        *(
+            fs.run(
+                "load",
+                listed_meta,
+                one.path,
+                getattr(sys.modules["models.core"], one.resource_type.title()),
+                query,
+            )
+            for one in entries
+        )
+    )
+    attachments_dict: dict[ResourceType, list[Any] | int] = {}
+    for one, meta in zip(entries, metas):
+        attachments_dict.setdefault(one.resource_type, []).append(
+            meta.to_record(
+                query.subpath + "/" + shortname,
+                one.shortname,
+                query.include_fields,
+                query.exclude_fields,
+            )
+        )
+    return attachments_dict
+
+
+async def row_record(
+    query: api.Query,
+    path: Path,
+    row: tuple[str, str, str],
+) -> core.Record:
+    """Record of a (kind, shortname, resource_type) row of the subpath"""
+    kind, shortname, resource_name = row
+    if kind == "folder":
+        folder = await fs.run(
+            "load",
+            listed_meta,
+            path / shortname / ".dm/meta.folder.json",
+            core.Folder,
+            query,
+        )
+        return folder.to_record(
+            query.subpath,
+            shortname,
+            query.include_fields,
+            query.exclude_fields,
+        )
+    resource_class = getattr(sys.modules["models.core"], resource_name.title())
+    resource_obj = await fs.run(
+        "load",
+        listed_meta,
+        path / ".dm" / shortname / f"meta.{resource_name}.json",
+        resource_class,
+        query,
+    )
+    return await entry_record(query, path, shortname, resource_obj)
+
+
+async def entry_record(
+    query: api.Query, path: Path, shortname: str, resource_obj: core.Meta
+) -> core.Record:
+    """Build the record of an entry found under path, with its json payload
+    (if requested) and its attachments"""
+    resource_base_record = resource_obj.to_record(
+        query.subpath, shortname, query.include_fields, query.exclude_fields
+    )
+    if query.attachments_mode != api.AttachmentsMode.none:
+        attachments = asyncio.ensure_future(
+            attachment_records(query, path, shortname)
+        )
+    else:
+        attachments = None
+
+    try:
+        if (
+            query.retrieve_json_payload
+            and resource_obj.payload
+            and resource_obj.payload.content_type
+            and resource_obj.payload.content_type == ContentType.json
+        ):
+            payload = await fs.run(
+                "payload", read_json_payload, path / resource_obj.payload.body
+            )
+            if payload is not None:
+                resource_base_record.attributes["payload"] = payload
+
+        if attachments:
+            resource_base_record.attachments = await attachments
+    finally:
+        if attachments:
+            attachments.cancel()
+    return resource_base_record
+
+
+async def iter_query(
+    query: api.Query, summary: dict[str, Any]
+) -> AsyncIterator[core.Record]:
+    """Given a query yield the records as they are read
 
     Parameters
     ----------
     query: api.Query
         query of type [spaces, search, subpath]
-
-    Returns
-    -------
-    Total, Records
+    summary: dict
+        Filled with the total and the cursor of the next page (None on the
+        last page) once the records are exhausted
 
     """
-    records: list[core.Record] = []
     total: int = 0
+    next_cursors: dict[str, Any] = {}
     match query.type:
         case api.QueryType.spaces:
-            path = settings.spaces_folder
-            spaces_glob = "*/.dm/meta.space.json"
-            for one in path.glob(spaces_glob):
+            for one in await fs.run("query", space_records, query):
                 total += 1
-                match = SPACES_PATTERN.search(str(one))
-                if match:
-                    records.append(
-                        core.Space.parse_raw(one.read_text()).to_record(
-                            query.subpath,
-                            match.group(1),
-                            query.include_fields if query.include_fields else [],
-                        )
-                    )
+                yield one
 
         case api.QueryType.search:
-            search_res: list = []
-            for schema_name in query.filter_schema_names:
-                search_res.extend(
-                    redis_search(
-                        space_name=query.space_name,
-                        schema_name=schema_name,
-                        search=query.search,
-                        filters={
-                            "resource_type": query.filter_types,
-                            "shortname": query.filter_shortnames,
-                            "tags": query.filter_tags,
-                            "subpath": [query.subpath] if query.subpath != "/" else [],
-                        },
-                        limit=query.limit,
-                        offset=query.offset,
-                        sort_by=query.sort_by,
-                    )
-                )
-            for one in search_res:
-                doc_content = json.loads(one.json)
-
+            total, hits, next_cursors = await search_page(query)
+            # Hits on a schema index are payload docs, their metas are fetched
+            # for the whole page in a single round trip
+            meta_docs = await get_docs_by_ids(
+                [
+                    doc["meta_doc_id"]
+                    for docid, doc in hits
+                    if not re.match(regex.META_DOC_ID, docid)
+                ]
+            )
+            for docid, doc_content in hits:
                 # This means redis returned content payload object not meta object
                 payload_doc_content = None
-                if not re.match(regex.META_DOC_ID, one.id):
+                if not re.match(regex.META_DOC_ID, docid):
                     payload_doc_content = doc_content
-                    doc_content = get_doc_by_id(payload_doc_content["meta_doc_id"])
+                    doc_content = meta_docs.get(payload_doc_content["meta_doc_id"])
+                    if doc_content is None:
+                        continue
 
                 if "tags" not in doc_content or doc_content["tags"] == "none":
                     doc_content["tags"] = []
@@ -177,6 +560,7 @@ async def serve_query(query: api.Query) -> tuple[int, list[core.Record]]:
                     doc_content["subpath"],
                     doc_content["shortname"],
                     query.include_fields,
+                    query.exclude_fields,
                 )
                 if payload_doc_content and query.retrieve_json_payload:
                     payload_doc_content.pop("subpath", None)
@@ -184,7 +568,7 @@ async def serve_query(query: api.Query) -> tuple[int, list[core.Record]]:
                     payload_doc_content.pop("shortname", None)
                     payload_doc_content.pop("meta_doc_id", None)
                     resource_base_record.attributes["payload"] = payload_doc_content
-                records.append(resource_base_record)
+                yield resource_base_record
 
         case api.QueryType.subpath:
             subpath = query.subpath
@@ -194,117 +578,109 @@ async def serve_query(query: api.Query) -> tuple[int, list[core.Record]]:
             if query.include_fields is None:
                 query.include_fields = []
 
-            # Gel all matching entries
-            entries_glob = ".dm/*/meta.*.json"
-            for one in path.glob(entries_glob):
-                match = FILE_PATTERN.search(str(one))
-                if not match or not one.is_file:
-                    logger.error("Invalid file pattern")
-                    continue
-                shortname = match.group(1)
-                resource_name = match.group(2).lower()
-                if (
-                    query.filter_types
-                    and not ResourceType(resource_name) in query.filter_types
-                ):
-                    logger.info(
-                        resource_name + " resource is not listed in filter types"
-                    )
-                    continue
-
-                if query.filter_shortnames and shortname not in query.filter_shortnames:
-                    continue
-
-                resource_class = getattr(
-                    sys.modules["models.core"], resource_name.title()
+            after = None
+            if query.after:
+                after = tuple(decode_cursor(query.after, valid_subpath_cursor)["p"])
+            # Rows past the page tell whether a next page exists, and are
+            # prefetched when reading json payloads
+            fetch = query.limit + 1
+            if query.retrieve_json_payload and settings.prefetch_pages:
+                fetch = max(2 * query.limit, query.limit + 1)
+            if settings.catalog_enabled:
+                total, rows = await fs.run(
+                    "query", catalog.query, query, after, fetch
                 )
-                resource_obj = resource_class.parse_raw(one.read_text())
-                if query.filter_tags and (
-                    not resource_obj.tags
-                    or not any(item in resource_obj.tags for item in query.filter_tags)
-                ):
-                    continue
-                total += 1
-                if len(records) >= query.limit or total < query.offset:
-                    continue
-
-                resource_base_record = resource_obj.to_record(
-                    query.subpath, shortname, query.include_fields
+            else:
+                matching = await fs.run("query", subpath_rows, query, path)
+                total = len(matching)
+                start = bisect.bisect_right(matching, after) if after else query.offset
+                rows = matching[start : start + fetch]
+
+            next_rows = rows[query.limit :]
+            if next_rows:
+                rows = rows[: query.limit]
+                next_cursors["p"] = list(rows[-1])
+
+            if next_rows and query.retrieve_json_payload and settings.prefetch_pages:
+                asyncio.get_running_loop().run_in_executor(
+                    fs.executor, prefetch_rows, path, next_rows
                 )
-                if (
-                    query.retrieve_json_payload
-                    and resource_obj.payload
-                    and resource_obj.payload.content_type
-                    and resource_obj.payload.content_type == ContentType.json
-                    and (path / resource_obj.payload.body).is_file()
-                ):
-                    async with aiofiles.open(
-                        path / resource_obj.payload.body, "r"
-                    ) as payload_file_content:
-                        resource_base_record.attributes["payload"] = json.loads(
-                            await payload_file_content.read()
-                        )
 
-                # Get all matching attachments
-                attachments_path = path / ".dm" / shortname
-                attachments_glob = "attachments.*/meta.*.json"
-                attachments_dict: dict[ResourceType, list[Any]] = {}
-                for one in attachments_path.glob(attachments_glob):
-                    match = ATTACHMENT_PATTERN.search(str(one))
-                    if not match or not one.is_file:
-                        logger.error("Invalid file pattern")
-                        continue
-                    attach_shortname = match.group(2)
-                    attach_resource_name = match.group(1).lower()
-                    if (
-                        query.filter_types
-                        and not ResourceType(attach_resource_name) in query.filter_types
-                    ):
-                        logger.info(
-                            attach_resource_name
-                            + " resource is not listed in filter types"
-                        )
-                        continue
-                    resource_class = getattr(
-                        sys.modules["models.core"], attach_resource_name.title()
+            # Rows are read concurrently and yielded in order. At most
+            # query_fanout records are read ahead of the consumer, so a slow
+            # stream does not hold the whole page in memory
+            pending: collections.deque[asyncio.Future] = collections.deque()
+            ahead = iter(rows)
+            try:
+                for row in itertools.islice(ahead, settings.query_fanout):
+                    pending.append(
+                        asyncio.ensure_future(row_record(query, path, row))
                     )
-                    resource_record_obj = resource_class.parse_raw(
-                        one.read_text()
-                    ).to_record(
-                        query.subpath + "/" + shortname,
-                        attach_shortname,
-                        query.include_fields,
-                    )
-                    if attach_resource_name in attachments_dict:
-                        attachments_dict[attach_resource_name].append(
-                            resource_record_obj
+                while pending:
+                    yield await pending.popleft()
+                    for row in itertools.islice(ahead, 1):
+                        pending.append(
+                            asyncio.ensure_future(row_record(query, path, row))
                         )
-                    else:
-                        attachments_dict[attach_resource_name] = [resource_record_obj]
+            finally:
+                for task in pending:
+                    task.cancel()
 
-                resource_base_record.attachments = attachments_dict
-                records.append(resource_base_record)
+    summary["total"] = total
+    summary["cursor"] = encode_cursor(next_cursors) if next_cursors else None
 
-            # Get all matching sub folders
-            subfolders_glob = "*/.dm/meta.folder.json"
-            for one in path.glob(subfolders_glob):
-                match = FOLDER_PATTERN.search(str(one))
 
-                if not match or not one.is_file:
-                    logger.error("Invalid file pattern")
-                    continue
-                shortname = match.group(1)
-                if query.filter_shortnames and shortname not in query.filter_shortnames:
-                    continue
-                total += 1
-                if len(records) >= query.limit or total < query.offset:
-                    continue
-                records.append(
-                    core.Folder.parse_raw(one.read_text()).to_record(
-                        query.subpath, shortname, query.include_fields
-                    )
-                )
-    return total, records
+async def serve_query(
+    query: api.Query,
+) -> tuple[int, list[core.Record], str | None]:
+    """Given a query return the total, the records and the cursor of the next page
+
+    Parameters
+    ----------
+    query: api.Query
+        query of type [spaces, search, subpath]
+
+    Returns
+    -------
+    Total, Records, Cursor (None on the last page)
+
+    """
+    summary: dict[str, Any] = {}
+    records = [record async for record in iter_query(query, summary)]
+    return summary["total"], records, summary["cursor"]
+
+
+async def stream_query(query: api.Query) -> AsyncIterator[bytes]:
+    """Serve the query as NDJSON: one line per record, then a summary line
+    with the total, the returned count and the next page cursor
+
+    The first line is read before returning, so that query errors are still
+    raised as api.Exception before the response starts
+    """
+    lines = ndjson_lines(query)
+    first = await anext(lines)
+
+    async def all_lines():
+        yield first
+        async for line in lines:
+            yield line
+
+    return all_lines()
+
+
+async def ndjson_lines(query: api.Query) -> AsyncIterator[bytes]:
+    summary: dict[str, Any] = {}
+    returned = 0
+    async for record in iter_query(query, summary):
+        returned += 1
+        yield record.json(exclude_none=True).encode() + b"\n"
+
+    attributes = {"total": summary["total"], "returned": returned}
+    if summary["cursor"]:
+        attributes["cursor"] = summary["cursor"]
+    yield api.Response(status=api.Status.success, attributes=attributes).json(
+        exclude_none=True
+    ).encode() + b"\n"
 
 
 def metapath(
@@ -315,7 +691,10 @@ def metapath(
     filename = ""
     if subpath[0] == "/":
         subpath = f".{subpath}"
-    if issubclass(class_type, core.Folder):
+    if issubclass(class_type, core.Space):
+        path = path / ".dm"
+        filename = f"meta.{class_type.__name__.lower()}.json"
+    elif issubclass(class_type, core.Folder):
         path = path / subpath / shortname / ".dm"
         filename = f"meta.{class_type.__name__.lower()}.json"
     elif issubclass(class_type, core.Attachment):
@@ -343,93 +722,301 @@ def payload_path(space_name: str, subpath: str, class_type: Type[MetaChild]) ->
     return path
 
 
-def load(
+async def load(
     space_name: str, subpath: str, shortname: str, class_type: Type[MetaChild]
 ) -> MetaChild:
     """Load a Meta Json according to the reuqested Class type"""
     path, filename = metapath(space_name, subpath, shortname, class_type)
     path /= filename
-    if not path.is_file():
+    try:
+        return await fs.run("load", meta_cache.get, path, class_type)
+    except FileNotFoundError:
         raise api.Exception(
             status_code=status.HTTP_404_NOT_FOUND,
             error=api.Error(type="db", code=12, message="requested object not found"),
         )
-    return class_type.parse_raw(path.read_text())
 
 
-async def save(space_name: str, subpath: str, meta: core.Meta):
-    """Save Meta Json to respectiv file"""
+def write_meta(space_name: str, subpath: str, meta: core.Meta):
+    """Write the meta file and refresh the cache and the catalog"""
     path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
 
     if not path.is_dir():
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
+
+    durable.write_text(path / filename, meta.json(exclude_none=True))
+    meta_cache.invalidate(path / filename)
+
+    if isinstance(meta, core.Space):
+        space_registry.notify()
+    if isinstance(meta, core.Schema):
+        schema_cache.invalidate(space_name, meta.shortname)
+    if settings.catalog_enabled:
+        catalog.upsert(space_name, subpath, meta)
+    index_meta(space_name, subpath, meta)
+
+
+def index_entry(space_name: str, subpath: str, meta: core.Meta):
+    """Queue the redis documents of the meta and of its json payload file"""
+    payload = None
+    if (
+        meta.payload
+        and meta.payload.content_type == ContentType.json
+        and meta.payload.schema_shortname
+        and isinstance(meta.payload.body, str)
+    ):
+        payload = read_json_payload(
+            payload_path(space_name, subpath, meta.__class__) / meta.payload.body
+        )
+    index_meta(space_name, subpath, meta, payload)
 
-    async with aiofiles.open(path / filename, "w") as file:
-        await file.write(meta.json(exclude_none=True))
+
+def reindex(
+    space_name: str,
+    subpath: str,
+    shortname: str,
+    class_type: Type[MetaChild],
+    schema_names: Iterable[str] = (),
+) -> core.Meta | None:
+    """Index the meta as found on disk, or unindex it if it is gone
+
+    The payload documents it may have under the other schema_names are removed.
+    Return the meta, None if it is gone
+    """
+    path, filename = metapath(space_name, subpath, shortname, class_type)
+    meta: core.Meta | None
+    try:
+        meta = meta_cache.get(path / filename, class_type)
+    except FileNotFoundError:
+        meta = None
+    if meta:
+        index_entry(space_name, subpath, meta)
+    else:
+        unindex_meta(space_name, subpath, class_type.construct(shortname=shortname))
+    current = meta.payload.schema_shortname if meta and meta.payload else None
+    for schema_name in schema_names:
+        if schema_name != current:
+            unindex_payload(space_name, subpath, shortname, schema_name)
+    return meta
 
 
-async def create(space_name: str, subpath: str, meta: core.Meta):
+def meta_exists(space_name: str, subpath: str, meta: core.Meta) -> bool:
+    path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
+    return (path / filename).is_file()
+
+
+def update_meta(
+    space_name: str,
+    subpath: str,
+    meta: core.Meta,
+    if_version: int | None = None,
+    must_exist: bool = True,
+):
+    """Write the meta as the next version of its file
+
+    The stored version is read, compared with if_version (when given) and
+    replaced under a short lock of the meta folder, so concurrent writers never
+    hold a lock across their own read-modify-write: the one that lost the race
+    gets a conflict instead of silently overwriting the other.
+    """
     path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
+    missing = api.Exception(
+        status_code=status.HTTP_404_NOT_FOUND,
+        error=api.Error(type="update", code=30, message="does not exist"),
+    )
+    if not path.is_dir():
+        if must_exist:
+            raise missing
+        os.makedirs(path, exist_ok=True)
+
+    with durable.locked_folder(path):
+        try:
+            current = orjson.loads((path / filename).read_bytes()).get("version", 0)
+        except FileNotFoundError:
+            if must_exist:
+                raise missing
+            current = None
+        if if_version is not None and current != if_version:
+            raise api.Exception(
+                status_code=status.HTTP_409_CONFLICT,
+                error=api.Error(
+                    type="update",
+                    code=31,
+                    message=f"version {if_version} is not the current {current}",
+                ),
+            )
+        meta.version = 0 if current is None else current + 1
+        write_meta(space_name, subpath, meta)
+
 
-    if (path / filename).is_file():
+async def save(space_name: str, subpath: str, meta: core.Meta):
+    """Save Meta Json to respectiv file"""
+    await fs.run("save", update_meta, space_name, subpath, meta, None, False)
+
+
+async def create(space_name: str, subpath: str, meta: core.Meta):
+    if await fs.run("create", meta_exists, space_name, subpath, meta):
         raise api.Exception(
             status_code=status.HTTP_400_BAD_REQUEST,
             error=api.Error(type="create", code=30, message="already exists"),
         )
 
-    if not path.is_dir():
-        os.makedirs(path)
+    await fs.run("create", write_meta, space_name, subpath, meta)
 
-    async with aiofiles.open(path / filename, "w") as file:
-        await file.write(meta.json(exclude_none=True))
 
+class StagedPayload(NamedTuple):
+    fd: int | None  # None when tmp links to an identical stored blob
+    tmp: Path  # written and hashed, not yet visible
+    path: Path
+    checksum: str
 
-async def save_payload(space_name: str, subpath: str, meta: core.Meta, attachment):
-    path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
+
+def write_staged_payload(space_name: str, path: Path, file: BinaryIO) -> StagedPayload:
+    """Copy file to a temporary file next to path, hashing it on the way
+
+    With content addressed payloads the file is hashed first, and nothing is
+    written when the space already stores the same content
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    if settings.content_addressed_payloads:
+        sha1 = hashlib.sha1()
+        while chunk := file.read(settings.upload_buffer_size):
+            sha1.update(chunk)
+        checksum = sha1.hexdigest()
+        tmp = blobs.link_temp(space_name, checksum, path)
+        if tmp:
+            return StagedPayload(None, tmp, path, checksum)
+        file.seek(0)
+
+    fd, tmp = durable.open_temp(path)
+    sha1 = hashlib.sha1()
+    try:
+        while chunk := file.read(settings.upload_buffer_size):
+            sha1.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view) :]
+    except BaseException:
+        durable.discard(fd, tmp)
+        raise
+    return StagedPayload(fd, tmp, path, sha1.hexdigest())
+
+
+def commit_staged_payload(space_name: str, staged: StagedPayload):
+    if not settings.content_addressed_payloads:
+        durable.commit(staged.fd, staged.tmp, staged.path)
+        return
+    previous = blobs.open_previous(staged.path)
+    if staged.fd is None:
+        blobs.replace(staged.tmp, staged.path)
+    else:
+        durable.commit(staged.fd, staged.tmp, staged.path)
+        blobs.adopt(space_name, staged.checksum, staged.path)
+    blobs.release_previous(space_name, previous)
+
+
+def discard_staged_payload(staged: StagedPayload):
+    if staged.fd is None:
+        os.unlink(staged.tmp)
+    else:
+        durable.discard(staged.fd, staged.tmp)
+
+
+def json_payload_bytes(payload_data: dict) -> bytes:
+    """Content of the file of a json payload, see save_payload_from_json"""
+    return orjson.dumps(payload_data)
+
+
+def write_payload_bytes(space_name: str, path: Path, data: bytes):
+    """Durably write a payload, as a link to an identical blob when possible"""
+    if not settings.content_addressed_payloads:
+        durable.write_bytes(path, data)
+        return
+
+    checksum = hashlib.sha1(data).hexdigest()
+    previous = blobs.open_previous(path)
+    tmp = blobs.link_temp(space_name, checksum, path)
+    if tmp:
+        blobs.replace(tmp, path)
+    else:
+        durable.write_bytes(path, data)
+        blobs.adopt(space_name, checksum, path)
+    blobs.release_previous(space_name, previous)
+
+
+async def stage_payload(
+    space_name: str, subpath: str, meta: core.Meta, attachment
+) -> StagedPayload:
+    """Stream the uploaded payload of meta to disk in a single pass
+
+    The payload only replaces the current one on save_payload, and is dropped
+    by discard_payload
+    """
     payload_file_path = payload_path(space_name, subpath, meta.__class__)
     payload_filename = meta.shortname + Path(attachment.filename).suffix
+    return await fs.run(
+        "payload",
+        write_staged_payload,
+        space_name,
+        payload_file_path / payload_filename,
+        attachment.file,
+    )
 
-    if not (path / filename).is_file():
+
+async def save_payload(
+    space_name: str, subpath: str, meta: core.Meta, staged: StagedPayload
+):
+    if not await fs.run("payload", meta_exists, space_name, subpath, meta):
+        await discard_payload(staged)
         raise api.Exception(
             status_code=status.HTTP_400_BAD_REQUEST,
             error=api.Error(type="create", code=30, message="metadata is missing"),
         )
 
-    async with aiofiles.open(payload_file_path / payload_filename, "wb") as file:
-        while content := await attachment.read(1024):
-            await file.write(content)
+    await fs.run("payload", commit_staged_payload, space_name, staged)
+    await fs.run("payload", index_entry, space_name, subpath, meta)
+
+
+async def discard_payload(staged: StagedPayload):
+    await fs.run("payload", discard_staged_payload, staged)
 
 
 async def save_payload_from_json(
     space_name: str, subpath: str, meta: core.Meta, payload_data: dict
 ):
-    path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
     payload_file_path = payload_path(space_name, subpath, meta.__class__)
     payload_filename = f"{meta.shortname}.json"
 
-    if not (path / filename).is_file():
+    if not await fs.run("payload", meta_exists, space_name, subpath, meta):
         raise api.Exception(
             status_code=status.HTTP_400_BAD_REQUEST,
             error=api.Error(type="create", code=30, message="metadata is missing"),
         )
 
-    async with aiofiles.open(payload_file_path / payload_filename, "w") as file:
-        await file.write(json.dumps(payload_data))
+    await fs.run(
+        "payload",
+        write_payload_bytes,
+        space_name,
+        payload_file_path / payload_filename,
+        json_payload_bytes(payload_data),
+    )
+    await fs.run("payload", index_meta, space_name, subpath, meta, payload_data)
 
 
-async def update(space_name: str, subpath: str, meta: core.Meta):
-    path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
-    if not (path / filename).is_file():
-        raise api.Exception(
-            status_code=status.HTTP_404_NOT_FOUND,
-            error=api.Error(type="update", code=30, message="does not exist"),
-        )
+async def update(
+    space_name: str, subpath: str, meta: core.Meta, if_version: int | None = None
+):
+    """Overwrite an existing meta, only if it is still at if_version when given
 
-    async with aiofiles.open(path / filename, "w") as file:
-        await file.write(meta.json(exclude_none=True))
+    Exception
+    ----------
+    api.Exception:
+        HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
+    """
+    await fs.run("update", update_meta, space_name, subpath, meta, if_version)
 
 
-async def move(
+def move_files(
     space_name: str,
     src_subpath: str,
     src_shortname: str,
@@ -437,17 +1024,11 @@ async def move(
     dest_shortname: str | None,
     meta: core.Meta,
 ):
-    """Move the file that match the criteria given, remove source folder if empty
-
-    Parameters
-    ----------
-    space_name: str,
-    src_subpath: str,
-    src_shortname: str,
-    dest_subpath: str | None,
-    dest_shortname: str | None,
-    meta: core.Meta
-    """
+    if isinstance(meta, core.Folder):
+        move_folder_files(
+            space_name, src_subpath, src_shortname, dest_subpath, dest_shortname, meta
+        )
+        return
 
     src_path, src_filename = metapath(
         space_name, src_subpath, src_shortname, meta.__class__
@@ -463,6 +1044,7 @@ async def move(
     if not os.path.isdir(dest_path):
         os.makedirs(dest_path)
 
+    src_meta = meta.copy()
     meta_updated = False
     # Incase of attachment, the shortname is a file so it should be moved
     # use is instance instead
@@ -500,30 +1082,103 @@ async def move(
 
     # Store meta updates in the file
     if meta_updated:
-        async with aiofiles.open(dest_path / dest_filename, "w") as opened_file:
-            await opened_file.write(meta.json(exclude_none=True))
+        durable.write_text(dest_path / dest_filename, meta.json(exclude_none=True))
+
+    meta_cache.invalidate(src_path / src_filename)
+    meta_cache.invalidate(dest_path / dest_filename)
 
     # Delete Src path if empty
     if src_path.is_dir() and len(os.listdir(src_path)) == 0:
         os.removedirs(src_path)
 
+    if settings.catalog_enabled:
+        catalog.remove(space_name, src_subpath, src_meta)
+        catalog.upsert(space_name, dest_subpath or src_subpath, meta)
+    unindex_meta(space_name, src_subpath, src_meta)
+    index_entry(space_name, dest_subpath or src_subpath, meta)
 
-def delete(space_name: str, subpath: str, meta: core.Meta):
-    """Delete the file that match the criteria given, remove folder if empty
 
-    Parameters
-    ----------
-    space_name: str
-    subpath: str
-    shortname: str
-    meta: Meta
+def move_folder_files(
+    space_name: str,
+    src_subpath: str,
+    src_shortname: str,
+    dest_subpath: str | None,
+    dest_shortname: str | None,
+    meta: core.Meta,
+):
+    """Move a folder with its whole subtree in one rename
 
-    Exception
+    The catalog rows follow in one statement, the redis documents of the
+    entries under it are moved in the background
+    """
+    dest_subpath = dest_subpath or src_subpath
+    dest_shortname = dest_shortname or src_shortname
+    src_path, filename = metapath(space_name, src_subpath, src_shortname, core.Folder)
+    dest_path, _ = metapath(space_name, dest_subpath, dest_shortname, core.Folder)
+    src_folder, dest_folder = src_path.parent, dest_path.parent
+    if not (src_path / filename).is_file():
+        raise api.Exception(
+            status_code=status.HTTP_404_NOT_FOUND,
+            error=api.Error(type="move", code=30, message="does not exist"),
+        )
+    if dest_folder.exists() or dest_folder.is_relative_to(src_folder):
+        raise api.Exception(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            error=api.Error(type="move", code=30, message="invalid destination"),
+        )
+
+    os.makedirs(dest_folder.parent, exist_ok=True)
+    os.rename(src_folder, dest_folder)
+    src_meta = meta.copy()
+    if meta.shortname != dest_shortname:
+        meta.shortname = dest_shortname
+        durable.write_text(dest_path / filename, meta.json(exclude_none=True))
+    meta_cache.invalidate(src_path / filename)
+    meta_cache.invalidate(dest_path / filename)
+
+    src_tree = join_subpath(src_subpath, src_shortname)
+    dest_tree = join_subpath(dest_subpath, dest_shortname)
+    if settings.catalog_enabled:
+        catalog.remove(space_name, src_subpath, src_meta)
+        catalog.upsert(space_name, dest_subpath, meta)
+        catalog.move_subtree(space_name, src_tree, dest_tree)
+    unindex_meta(space_name, src_subpath, src_meta)
+    index_meta(space_name, dest_subpath, meta)
+    reclaimer.reindex(space_name, src_tree, dest_tree)
+
+
+async def move(
+    space_name: str,
+    src_subpath: str,
+    src_shortname: str,
+    dest_subpath: str | None,
+    dest_shortname: str | None,
+    meta: core.Meta,
+):
+    """Move the file that match the criteria given, remove source folder if empty
+
+    Parameters
     ----------
-    api.Exception:
-        HTTP_404_NOT_FOUND
+    space_name: str,
+    src_subpath: str,
+    src_shortname: str,
+    dest_subpath: str | None,
+    dest_shortname: str | None,
+    meta: core.Meta
     """
+    await fs.run(
+        "move",
+        move_files,
+        space_name,
+        src_subpath,
+        src_shortname,
+        dest_subpath,
+        dest_shortname,
+        meta,
+    )
+
 
+def delete_files(space_name: str, subpath: str, meta: core.Meta):
     path, filename = metapath(space_name, subpath, meta.shortname, meta.__class__)
     if not path.is_dir() or not (path / filename).is_file():
         raise api.Exception(
@@ -531,16 +1186,110 @@ def delete(space_name: str, subpath: str, meta: core.Meta):
             error=api.Error(type="delete", code=30, message="does not exist"),
         )
 
+    if isinstance(meta, core.Folder):
+        delete_folder_files(space_name, subpath, meta, path / filename)
+        return
+
     pathname = path / filename
     if pathname.is_file():
         os.remove(pathname)
-        media_name = filename.split(".")[1]
-        files = os.listdir(path)
-        for file in files:
-            if media_name in file:
-                os.remove(path / file)
-                break
+        meta_cache.invalidate(pathname)
+        if (
+            meta.payload
+            and isinstance(meta.payload.body, str)
+            and Path(meta.payload.body).name == meta.payload.body
+        ):
+            payload_file = (
+                payload_path(space_name, subpath, meta.__class__) / meta.payload.body
+            )
+            if payload_file.is_file():
+                os.remove(payload_file)
+        if (
+            settings.content_addressed_payloads
+            and meta.payload
+            and meta.payload.checksum
+        ):
+            blobs.release(space_name, meta.payload.checksum)
 
     # Remove folder if empty
     if len(os.listdir(path)) == 0:
         os.removedirs(path)
+
+    if isinstance(meta, core.Space):
+        space_registry.notify()
+    if isinstance(meta, core.Schema):
+        schema_cache.invalidate(space_name, meta.shortname)
+    if settings.catalog_enabled:
+        catalog.remove(space_name, subpath, meta)
+    unindex_meta(space_name, subpath, meta)
+
+
+def delete_folder_files(
+    space_name: str, subpath: str, meta: core.Meta, meta_file: Path
+):
+    """Take the folder and its whole subtree out of the space in one rename
+
+    The files and the redis documents under it are reclaimed in the background
+    """
+    tree = join_subpath(subpath, meta.shortname)
+    trashed = move_to_trash(space_name, meta_file.parent.parent, tree)
+    meta_cache.invalidate(meta_file)
+    if settings.catalog_enabled:
+        catalog.remove(space_name, subpath, meta)
+        catalog.remove_subtree(space_name, tree)
+    unindex_meta(space_name, subpath, meta)
+    reclaimer.purge(space_name, trashed)
+
+
+def rolled_back(space_name: str, locations: list[tuple[str, str, str, str | None]]):
+    """Resync the derived state of the (subpath, shortname, resource_type,
+    schema_shortname) resources whose files were restored by a rollback
+
+    The batch may have indexed payloads under the schema of its records, or
+    under the schema of the metas it moved, which are back on disk now. The
+    meta cache and the schema validators check the files they cached.
+    """
+    schema_names = {schema for *_, schema in locations if schema}
+    classes = [
+        getattr(sys.modules["models.core"], resource_type.title())
+        for _, _, resource_type, _ in locations
+    ]
+    for (subpath, shortname, _, _), class_type in zip(locations, classes):
+        path, filename = metapath(space_name, subpath, shortname, class_type)
+        try:
+            meta = meta_cache.get(path / filename, class_type)
+        except FileNotFoundError:
+            continue
+        if meta.payload and meta.payload.schema_shortname:
+            schema_names.add(meta.payload.schema_shortname)
+
+    for (subpath, shortname, _, _), class_type in zip(locations, classes):
+        if issubclass(class_type, core.Space):
+            space_registry.notify()
+        if settings.catalog_enabled and issubclass(class_type, core.Folder):
+            catalog.refresh_subtree(space_name, join_subpath(subpath, shortname))
+        meta = reindex(space_name, subpath, shortname, class_type, schema_names)
+        if settings.catalog_enabled and meta:
+            catalog.upsert(space_name, subpath, meta)
+        elif settings.catalog_enabled:
+            catalog.remove(
+                space_name, subpath, class_type.construct(shortname=shortname)
+            )
+
+
+async def delete(space_name: str, subpath: str, meta: core.Meta):
+    """Delete the file that match the criteria given, remove folder if empty
+
+    Parameters
+    ----------
+    space_name: str
+    subpath: str
+    shortname: str
+    meta: Meta
+
+    Exception
+    ----------
+    api.Exception:
+        HTTP_404_NOT_FOUND
+    """
+    await fs.run("delete", delete_files, space_name, subpath, meta)
@@ -0,0 +1,170 @@
+""" Crash-safe file writes with group commit
+
+Files are never written in place: the content goes to a temporary file in the
+same folder, which is fsynced and then renamed over the final path, so readers
+see either the old or the new file and never a truncated one.
+
+Fsyncs are batched across concurrent writers: the first writer to arrive
+becomes the leader, waits `fsync_window_ms` for others to join, then syncs the
+whole batch (one fsync per file plus one per parent folder) and wakes everyone.
+Each writer returns only once its own file is durable.
+"""
+
+import contextlib
+import fcntl
+import os
+import threading
+import time
+from pathlib import Path
+from uuid import uuid4
+from utils.settings import settings
+
+
+class _Write:
+    __slots__ = ("fd", "tmp", "final", "done", "error")
+
+    def __init__(self, fd: int, tmp: Path, final: Path):
+        self.fd = fd
+        self.tmp = tmp
+        self.final = final
+        self.done = False
+        self.error: BaseException | None = None
+
+
+class GroupCommit:
+    def __init__(self, window: float, sync: bool = True):
+        self.window = window
+        self.sync = sync
+        self.batches = 0
+        self.writes = 0
+        self._pending: list[_Write] = []
+        self._leader = False
+        self._condition = threading.Condition()
+
+    def commit(self, fd: int, tmp: Path, final: Path):
+        """Sync and close fd, then rename tmp over final. Blocks until durable"""
+        write = _Write(fd, tmp, final)
+        with self._condition:
+            self._pending.append(write)
+            while self._leader and not write.done:
+                self._condition.wait()
+            if not write.done:
+                self._leader = True
+
+        if not write.done:
+            try:
+                if self.window > 0:
+                    time.sleep(self.window)
+                with self._condition:
+                    batch, self._pending = self._pending, []
+                self._flush(batch)
+            finally:
+                with self._condition:
+                    self._leader = False
+                    self._condition.notify_all()
+
+        if write.error:
+            raise write.error
+
+    def _flush(self, batch: list[_Write]):
+        folders: dict[Path, list[_Write]] = {}
+        for write in batch:
+            try:
+                try:
+                    if self.sync:
+                        os.fsync(write.fd)
+                finally:
+                    os.close(write.fd)
+                os.replace(write.tmp, write.final)
+                folders.setdefault(write.final.parent, []).append(write)
+            except BaseException as e:
+                write.error = e
+                _unlink(write.tmp)
+
+        # The renames are only durable once their folders are synced
+        if self.sync:
+            for folder, writes in folders.items():
+                try:
+                    _fsync_folder(folder)
+                except OSError as e:
+                    for write in writes:
+                        write.error = e
+
+        with self._condition:
+            for write in batch:
+                write.done = True
+            self.batches += 1
+            self.writes += len(batch)
+
+    def stats(self) -> dict[str, int]:
+        return {"batches": self.batches, "writes": self.writes}
+
+
+group_commit = GroupCommit(settings.fsync_window_ms / 1000, settings.fsync_writes)
+
+
+def _fsync_folder(folder: Path):
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_folder(folder: Path):
+    """Make the entries created in folder durable"""
+    if settings.fsync_writes:
+        _fsync_folder(folder)
+
+
+@contextlib.contextmanager
+def locked_folder(folder: Path):
+    """Hold an exclusive lock on the folder, against other threads and workers"""
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+def _unlink(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_temp(path: Path) -> tuple[int, Path]:
+    """Open a new temporary file next to path, for a later commit"""
+    tmp = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+    return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), tmp
+
+
+def discard(fd: int, tmp: Path):
+    """Close and remove a temporary file that will not be committed"""
+    os.close(fd)
+    _unlink(tmp)
+
+
+def commit(fd: int, tmp: Path, path: Path):
+    """Durably replace path with the temporary file from open_temp"""
+    group_commit.commit(fd, tmp, path)
+
+
+def write_bytes(path: Path, data: bytes):
+    """Atomically and durably replace the content of path"""
+    fd, tmp = open_temp(path)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    except BaseException:
+        discard(fd, tmp)
+        raise
+    commit(fd, tmp, path)
+
+
+def write_text(path: Path, text: str):
+    write_bytes(path, text.encode())
@@ -0,0 +1,49 @@
+""" Dedicated thread pool for blocking filesystem work
+
+The event loop must never wait on the disk: every glob, stat, read, write,
+rename and remove done by utils.db is handed to this bounded executor, and
+the latency of each operation (including the time spent queued) is recorded.
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+from utils.settings import settings
+
+T = TypeVar("T")
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.fs_workers, thread_name_prefix="dmart-fs"
+)
+
+# operation -> [count, total seconds, max seconds]
+_latencies: dict[str, list[float]] = {}
+
+
+async def run(operation: str, function: Callable[..., T], *args: Any) -> T:
+    """Run function(*args) on the filesystem executor, recording its latency"""
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(function, *args)
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        latency = _latencies.setdefault(operation, [0, 0.0, 0.0])
+        latency[0] += 1
+        latency[1] += elapsed
+        latency[2] = max(latency[2], elapsed)
+
+
+def metrics() -> dict[str, dict[str, float]]:
+    """Count, average and max latency in milliseconds per operation"""
+    return {
+        operation: {
+            "count": count,
+            "avg_ms": 1000 * total / count,
+            "max_ms": 1000 * longest,
+        }
+        for operation, (count, total, longest) in _latencies.items()
+    }
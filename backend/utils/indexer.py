@@ -0,0 +1,155 @@
+""" Write-through indexing of the spaces that have indexing enabled
+
+Every mutation done by utils.db enqueues the new redis document of the meta
+(and of its json payload when it follows a schema), or the deletion of its doc
+ids. A background task drains the queue: writes to the same doc id that are
+still pending are coalesced into the latest one, and each batch is sent to
+redis as a single pipeline on the pooled async client. The lag is the age of
+the oldest pending write.
+"""
+
+import asyncio
+import threading
+import time
+import models.core as core
+from models.enums import ContentType
+from utils.logger import logger
+from utils.redis_services import meta_doc, payload_doc, generate_doc_id, write_docs
+from utils.settings import settings
+from utils.space_registry import space_registry
+
+
+class Indexer:
+    def __init__(self):
+        self.indexed = 0
+        self.failed = 0
+        # doc id -> (document or None to delete it, time of the oldest write)
+        self._pending: dict[str, tuple[dict | None, float]] = {}
+        self._inflight_since: float | None = None
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def enqueue(self, docid: str, doc: dict | None):
+        """Queue a document write (or a delete with None), from any thread"""
+        with self._lock:
+            previous = self._pending.get(docid)
+            since = previous[1] if previous else time.monotonic()
+            self._pending[docid] = (doc, since)
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        """Start draining the queue on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        assert self._wakeup
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while batch := self._take(settings.indexer_batch_size):
+                self._inflight_since = min(since for _, since in batch.values())
+                try:
+                    await write_docs({docid: doc for docid, (doc, _) in batch.items()})
+                    self.indexed += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.info(f"Indexing {len(batch)} documents failed: {e}")
+                    self._requeue(batch)
+                    await asyncio.sleep(settings.indexer_retry_seconds)
+                finally:
+                    self._inflight_since = None
+
+    def _take(self, size: int) -> dict[str, tuple[dict | None, float]]:
+        with self._lock:
+            docids = list(self._pending)[:size]
+            return {docid: self._pending.pop(docid) for docid in docids}
+
+    def _requeue(self, batch: dict[str, tuple[dict | None, float]]):
+        with self._lock:
+            for docid, entry in batch.items():
+                # Newer writes of the same doc replace the failed one
+                self._pending.setdefault(docid, entry)
+
+    def lag(self) -> float:
+        """Seconds since the oldest write that redis has not received yet"""
+        with self._lock:
+            oldest = [since for _, since in self._pending.values()]
+        if self._inflight_since is not None:
+            oldest.append(self._inflight_since)
+        return time.monotonic() - min(oldest) if oldest else 0.0
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "pending": len(self._pending),
+            "lag_seconds": self.lag(),
+            "indexed": self.indexed,
+            "failed": self.failed,
+        }
+
+
+indexer = Indexer()
+
+
+def indexing_enabled(space_name: str) -> bool:
+    space = space_registry.refresh().get(space_name)
+    return bool(space and space.indexing_enabled)
+
+
+def index_meta(
+    space_name: str, subpath: str, meta: core.Meta, payload: dict | None = None
+):
+    """Queue the documents of a written meta, and of its json payload if given"""
+    if not indexing_enabled(space_name) or isinstance(meta, core.Space):
+        return
+    subpath = subpath.strip("/")
+    indexer.enqueue(*meta_doc(space_name, "meta", subpath, meta))
+    if (
+        payload is not None
+        and meta.payload
+        and meta.payload.content_type == ContentType.json
+        and meta.payload.schema_shortname
+    ):
+        indexer.enqueue(
+            *payload_doc(
+                space_name,
+                meta.payload.schema_shortname,
+                subpath,
+                meta.shortname,
+                dict(payload),
+            )
+        )
+
+
+def unindex_meta(space_name: str, subpath: str, meta: core.Meta):
+    """Queue the deletion of the documents of a removed meta"""
+    if not indexing_enabled(space_name) or isinstance(meta, core.Space):
+        return
+    subpath = subpath.strip("/")
+    indexer.enqueue(generate_doc_id(space_name, "meta", meta.shortname, subpath), None)
+    if meta.payload and meta.payload.schema_shortname:
+        unindex_payload(
+            space_name, subpath, meta.shortname, meta.payload.schema_shortname
+        )
+
+
+def unindex_payload(
+    space_name: str, subpath: str, shortname: str, schema_shortname: str
+):
+    """Queue the deletion of the payload document of an entry under a schema"""
+    if not indexing_enabled(space_name):
+        return
+    indexer.enqueue(
+        generate_doc_id(space_name, schema_shortname, shortname, subpath.strip("/")),
+        None,
+    )
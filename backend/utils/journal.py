@@ -0,0 +1,176 @@
+""" Undo journal of atomic requests
+
+Before an atomic batch touches the disk, every path it may change is captured
+under `<space>/.dm/.journal/<batch>/`. Files are captured as hard links, which
+is enough because utils.db never writes a file in place (it renames a new file
+over it), so the journal keeps the pre-image while the batch replaces or
+removes the originals. The manifest of the captured paths is written last and
+fsynced once for the whole batch, together with the journal folder.
+
+A batch that fails is rolled back from its journal, and journals left behind
+by a crash are rolled back on startup. A batch keeps its journal folder locked
+while it runs, so a worker starting meanwhile leaves it alone.
+"""
+
+import fcntl
+import os
+import shutil
+from pathlib import Path
+from uuid import uuid4
+import orjson
+import utils.durable as durable
+from utils.settings import settings
+
+JOURNAL_FOLDER = ".journal"
+MANIFEST_FILENAME = "manifest.json"
+
+
+def journals_path(space_name: str) -> Path:
+    return settings.spaces_folder / space_name / ".dm" / JOURNAL_FOLDER
+
+
+def _lock(path: Path, operation: int) -> int:
+    """Open and flock the folder, the lock lasts until the descriptor is closed"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, operation)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        os.unlink(path)
+
+
+class Journal:
+    def __init__(self, space_name: str, path: Path | None = None):
+        self.space_name = space_name
+        self.path = path or journals_path(space_name) / uuid4().hex
+        self.targets: list[dict] = []
+        # (subpath, shortname, resource_type, schema_shortname) of the resources
+        self.locations: list[tuple[str, str, str, str | None]] = []
+        self._links = 0
+        self._fd: int | None = None
+
+    def capture(
+        self, paths: list[Path], locations: list[tuple[str, str, str, str | None]]
+    ):
+        """Record the current state of the paths, durably, before any change"""
+        root = journals_path(self.space_name)
+        os.makedirs(root, exist_ok=True)
+        # recover() holds the root exclusively, it never sees an unlocked batch
+        root_fd = _lock(root, fcntl.LOCK_SH)
+        try:
+            os.makedirs(self.path)
+            self._fd = _lock(self.path, fcntl.LOCK_EX)
+        finally:
+            os.close(root_fd)
+
+        self.locations = locations
+        try:
+            self._capture(paths)
+        except BaseException:
+            # The batch has not changed anything yet
+            self.discard()
+            raise
+
+    def _capture(self, paths: list[Path]):
+        space_path = settings.spaces_folder / self.space_name
+        captured: list[Path] = []
+        # A path inside an already captured folder is restored with that folder
+        for path in sorted({Path(os.path.normpath(one)) for one in paths}):
+            if any(path.is_relative_to(one) for one in captured):
+                continue
+            captured.append(path)
+            target: dict = {
+                "path": str(path.relative_to(space_path)),
+                "existed": path.exists(),
+                "folders": [],
+                "files": {},
+            }
+            if path.is_dir():
+                for dirpath, dirnames, filenames in os.walk(path):
+                    folder = Path(dirpath)
+                    target["folders"].append(str(folder.relative_to(path)))
+                    for filename in filenames:
+                        self._link(target, folder / filename, path)
+            elif path.is_file():
+                self._link(target, path, path)
+            self.targets.append(target)
+
+        # One sync for the manifest and the links next to it, one for the batch
+        durable.write_bytes(
+            self.path / MANIFEST_FILENAME,
+            orjson.dumps({"targets": self.targets, "locations": self.locations}),
+        )
+        durable.sync_folder(self.path.parent)
+
+    def _link(self, target: dict, file: Path, root: Path):
+        name = str(self._links)
+        self._links += 1
+        os.link(file, self.path / name, follow_symlinks=False)
+        target["files"][str(file.relative_to(root))] = name
+
+    def rollback(self):
+        """Put every captured path back in its captured state
+
+        The journal keeps its links until the end, so a rollback interrupted
+        by a crash can simply be run again
+        """
+        space_path = settings.spaces_folder / self.space_name
+        for target in self.targets:
+            path = space_path / target["path"]
+            _remove(path)
+            if not target["existed"]:
+                continue
+            for folder in target["folders"]:
+                os.makedirs(path / folder, exist_ok=True)
+            for relative, name in target["files"].items():
+                file = path / relative
+                os.makedirs(file.parent, exist_ok=True)
+                os.link(self.path / name, file, follow_symlinks=False)
+        self.discard()
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def recover(space_name: str) -> list[Journal]:
+    """Roll back the batches interrupted by a crash, return their journals
+
+    Workers recover one at a time, and skip the batches that are still running
+    """
+    recovered: list[Journal] = []
+    root = journals_path(space_name)
+    if not root.is_dir():
+        return recovered
+    root_fd = _lock(root, fcntl.LOCK_EX)
+    try:
+        for one in root.iterdir():
+            try:
+                fd = _lock(one, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (BlockingIOError, FileNotFoundError):
+                continue
+            journal = Journal(space_name, one)
+            journal._fd = fd
+            manifest = one / MANIFEST_FILENAME
+            if manifest.is_file():
+                content = orjson.loads(manifest.read_bytes())
+                journal.targets = content["targets"]
+                journal.locations = [tuple(x) for x in content.get("locations", [])]
+                journal.rollback()
+                recovered.append(journal)
+            else:
+                # Without a manifest the batch had not changed anything yet
+                journal.discard()
+    finally:
+        os.close(root_fd)
+    return recovered
@@ -0,0 +1,98 @@
+""" In-process LRU cache of parsed meta files """
+
+import os
+import threading
+import orjson
+from collections import OrderedDict
+from pathlib import Path
+from typing import Type, TypeVar
+import models.core as core
+from utils.settings import settings
+
+MetaChild = TypeVar("MetaChild", bound=core.Meta)
+
+
+class MetaCache:
+    """Bounded LRU of parsed Meta objects keyed by the absolute meta path
+
+    Entries are validated against the (mtime, inode, size) of the file on
+    every hit, so edits made outside of utils.db are still picked up.
+    Callers receive a copy and may modify it freely.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[tuple, type, core.Meta]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path, class_type: Type[MetaChild]) -> MetaChild:
+        """Return the parsed meta file, raise FileNotFoundError if missing"""
+        key, signature, meta = self._lookup(path, class_type)
+        if meta:
+            return meta
+
+        meta = class_type.parse_raw(Path(key).read_text())
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = (signature, class_type, meta)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return self._copy(meta)
+
+    def get_projection(
+        self, path: Path, class_type: Type[MetaChild], fields: set[str]
+    ) -> MetaChild:
+        """Like get, but a miss only decodes the given fields and builds the
+        model without validation. Such partial objects are not cached."""
+        key, _, meta = self._lookup(path, class_type)
+        if meta:
+            return meta
+
+        raw = orjson.loads(Path(key).read_bytes())
+        values = {field: raw[field] for field in fields if field in raw}
+        if isinstance(values.get("payload"), dict):
+            values["payload"] = core.Payload.construct(**values["payload"])
+        return class_type.construct(**values)
+
+    def _lookup(
+        self, path: Path, class_type: Type[MetaChild]
+    ) -> tuple[str, tuple, MetaChild | None]:
+        """Key, file signature and a copy of the cached meta if still valid"""
+        key = os.path.abspath(path)
+        try:
+            stat = os.stat(key)
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise
+        signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == signature and entry[1] is class_type:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, signature, self._copy(entry[2])
+            self.misses += 1
+        return key, signature, None
+
+    def invalidate(self, path: Path):
+        with self._lock:
+            self._entries.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _copy(meta: MetaChild) -> MetaChild:
+        # Deep, so that tags and payload bodies are not shared with the cache
+        return meta.copy(deep=True)
+
+
+meta_cache = MetaCache(settings.meta_cache_size)
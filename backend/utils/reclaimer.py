@@ -0,0 +1,168 @@
+""" Background reclamation of deleted and relocated folder subtrees
+
+Deleting a folder renames its whole subtree into `<space>/.dm/.trash/<id>/`,
+which is instant and atomic for clients, and queues the subtree here. Moving a
+folder renames the subtree in place and queues the re-indexing of the entries
+under it. A background task then works through the queue in small steps
+(`reclaim_batch_size` files, then a `reclaim_pause_ms` pause) so that large
+cleanups never compete with requests for long: it unindexes and removes the
+trashed files (and the blobs they were the last to use), or moves the redis
+documents of relocated entries.
+"""
+
+import asyncio
+import os
+import shutil
+from pathlib import Path
+from typing import Iterator
+from uuid import uuid4
+import orjson
+import models.core as core
+import utils.blobs as blobs
+import utils.fs as fs
+from utils.indexer import index_meta, indexing_enabled, unindex_meta
+from utils.logger import logger
+from utils.settings import settings
+from utils.walker import walk_tree
+
+TRASH_FOLDER = ".trash"
+ORIGIN_FILENAME = "origin.json"
+TREE_FOLDER = "tree"
+
+
+def trash_path(space_name: str) -> Path:
+    return settings.spaces_folder / space_name / ".dm" / TRASH_FOLDER
+
+
+def join_subpath(subpath: str, relative: str) -> str:
+    return "/".join(one for one in (subpath.strip("/"), relative) if one)
+
+
+def move_to_trash(space_name: str, folder: Path, subpath: str) -> Path:
+    """Atomically take the folder (found at subpath) out of the space"""
+    trashed = trash_path(space_name) / uuid4().hex
+    os.makedirs(trashed)
+    (trashed / ORIGIN_FILENAME).write_bytes(orjson.dumps({"subpath": subpath}))
+    os.rename(folder, trashed / TREE_FOLDER)
+    return trashed
+
+
+def _metas(tree: Path) -> Iterator[tuple[str, Path, core.Meta]]:
+    for relative, one in walk_tree(tree):
+        resource_class = getattr(core, one.resource_type.title())
+        try:
+            meta = resource_class.parse_raw(one.path.read_bytes())
+        except (OSError, ValueError):
+            continue
+        yield relative, one.path.relative_to(tree), meta
+
+
+def _purge_steps(space_name: str, trashed: Path) -> Iterator[None]:
+    """Unindex then remove a trashed subtree, yielding between batches"""
+    tree = trashed / TREE_FOLDER
+    origin = orjson.loads((trashed / ORIGIN_FILENAME).read_bytes())["subpath"]
+    origin_path = settings.spaces_folder / space_name / origin
+    count = 0
+    if indexing_enabled(space_name):
+        for relative, meta_file, meta in _metas(tree):
+            # A rolled back batch restores the subtree while its trash remains
+            if not (origin_path / meta_file).is_file():
+                unindex_meta(space_name, join_subpath(origin, relative), meta)
+            count += 1
+            if count % settings.reclaim_batch_size == 0:
+                yield
+
+    for dirpath, dirnames, filenames in os.walk(tree, topdown=False):
+        for filename in filenames:
+            os.unlink(os.path.join(dirpath, filename))
+            count += 1
+            if count % settings.reclaim_batch_size == 0:
+                yield
+        for dirname in dirnames:
+            os.rmdir(os.path.join(dirpath, dirname))
+    shutil.rmtree(trashed)
+    if settings.content_addressed_payloads:
+        blobs.collect(space_name)
+
+
+def _reindex_steps(
+    space_name: str, src_subpath: str, dest_subpath: str
+) -> Iterator[None]:
+    """Move the redis documents of the entries under a relocated subtree"""
+    if not indexing_enabled(space_name):
+        return
+    tree = settings.spaces_folder / space_name / dest_subpath.strip("/")
+    for count, (relative, _, meta) in enumerate(_metas(tree), 1):
+        unindex_meta(space_name, join_subpath(src_subpath, relative), meta)
+        index_meta(space_name, join_subpath(dest_subpath, relative), meta)
+        if count % settings.reclaim_batch_size == 0:
+            yield
+
+
+class Reclaimer:
+    def __init__(self):
+        self.reclaimed = 0
+        self._queue: asyncio.Queue[tuple[str, Iterator[None]]] | None = None
+        self._backlog: list[tuple[str, Iterator[None]]] = []
+        self._task: asyncio.Task | None = None
+
+    def _put(self, description: str, steps: Iterator[None]):
+        if self._queue:
+            self._queue.put_nowait((description, steps))
+        else:
+            self._backlog.append((description, steps))
+
+    def purge(self, space_name: str, trashed: Path):
+        self._put(f"purge {trashed}", _purge_steps(space_name, trashed))
+
+    def reindex(self, space_name: str, src_subpath: str, dest_subpath: str):
+        self._put(
+            f"reindex {space_name}/{src_subpath}",
+            _reindex_steps(space_name, src_subpath, dest_subpath),
+        )
+
+    def start(self, space_names: list[str]):
+        """Start the worker on the running loop, resuming the leftover trash"""
+        self._queue = asyncio.Queue()
+        for job in self._backlog:
+            self._queue.put_nowait(job)
+        self._backlog.clear()
+        for space_name in space_names:
+            if trash_path(space_name).is_dir():
+                for trashed in trash_path(space_name).iterdir():
+                    if (trashed / ORIGIN_FILENAME).is_file():
+                        self.purge(space_name, trashed)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        assert self._queue
+        while True:
+            description, steps = await self._queue.get()
+            try:
+                while await fs.run("reclaim", next, steps, False) is not False:
+                    await asyncio.sleep(settings.reclaim_pause_ms / 1000)
+                self.reclaimed += 1
+            except Exception as e:
+                logger.info(f"Reclaiming failed, {description}: {e}")
+
+    def stats(self) -> dict[str, int]:
+        pending = len(self._backlog) + (self._queue.qsize() if self._queue else 0)
+        return {"pending": pending, "reclaimed": self.reclaimed}
+
+    def run_pending(self):
+        """Run the queued jobs to completion in the calling thread"""
+        jobs, self._backlog = self._backlog, []
+        while self._queue and not self._queue.empty():
+            jobs.append(self._queue.get_nowait())
+        for _, steps in jobs:
+            for _ in steps:
+                pass
+            self.reclaimed += 1
+
+
+reclaimer = Reclaimer()
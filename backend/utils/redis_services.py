@@ -1,19 +1,143 @@
 from http import HTTPStatus
 import re
 import json
-import redis
+import asyncio
+import time
+import weakref
+from typing import AsyncIterator
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError, ResponseError
 import models.api as api
 import models.core as core
 from redis.commands.json.path import Path
 from redis.commands.search.field import TextField, NumericField, TagField
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.commands.search import Search
+from redis.commands.search import AsyncSearch
 from redis.commands.search.query import Query
 from utils.settings import settings
 
 
-client = redis.Redis(host=settings.redis_host, port=6379)
-redis_indices: dict[str, dict[str, Search]] = {}
+class MeteredPool(aioredis.BlockingConnectionPool):
+    """Connection pool that waits (up to a timeout) for a free connection
+    instead of opening more than max_connections, and keeps wait metrics"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.acquired = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        # Counted here rather than read from the internals of redis-py
+        self._opened: weakref.WeakSet = weakref.WeakSet()
+        self._lent: set = set()
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.monotonic()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            # No free connection in time, or redis unreachable
+            self.failed += 1
+            raise
+        finally:
+            self.wait_seconds += time.monotonic() - start
+        self.acquired += 1
+        self._opened.add(connection)
+        self._lent.add(connection)
+        return connection
+
+    async def release(self, connection):
+        self._lent.discard(connection)
+        await super().release(connection)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "max_connections": self.max_connections,
+            "open": len(self._opened),
+            "in_use": len(self._lent),
+            "acquired": self.acquired,
+            "failed": self.failed,
+            "wait_seconds": self.wait_seconds,
+        }
+
+
+pool = MeteredPool(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    max_connections=settings.redis_pool_size,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    socket_connect_timeout=settings.redis_socket_timeout,
+)
+client = aioredis.Redis(connection_pool=pool)
+redis_indices: dict[str, dict[str, AsyncSearch]] = {}
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+class IndexRegistry:
+    """Names and fields of the redis indices, loaded once and kept in memory
+
+    Searches check the index and its fields here instead of an FT.INFO round
+    trip each. The registry reloads after `redis_index_ttl` seconds, or on the
+    next use after invalidate() (called whenever this process creates an
+    index). Indices created by other processes show up within the TTL.
+    """
+
+    def __init__(self):
+        # index name -> field name -> (json path, field type)
+        self.indices: dict[str, dict[str, tuple[str, str]]] = {}
+        self.loads = 0
+        self._loaded_at: float | None = None
+        self._loading: asyncio.Task | None = None
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _fresh(self) -> bool:
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < settings.redis_index_ttl
+        )
+
+    async def refresh(self) -> dict[str, dict[str, tuple[str, str]]]:
+        if not self._fresh():
+            # Concurrent searches share a single reload
+            if not self._loading or self._loading.done():
+                self._loading = asyncio.create_task(self._load())
+            await asyncio.shield(self._loading)
+        return self.indices
+
+    async def _load(self):
+        indices: dict[str, dict[str, tuple[str, str]]] = {}
+        # Searches go through the alias of the serving version of each index
+        for name in {index_alias(one) for one in await list_indices()}:
+            try:
+                info = await client.ft(name).info()
+            except ResponseError:
+                # First version still building, there is no alias yet
+                continue
+            fields: dict[str, tuple[str, str]] = {}
+            for attribute in info.get("attributes", []):
+                values = dict(zip(attribute[::2], attribute[1::2]))
+                values = {_text(key): _text(value) for key, value in values.items()}
+                fields[values["attribute"]] = (values["identifier"], values["type"])
+            indices[name] = fields
+        self.indices = indices
+        self._loaded_at = time.monotonic()
+        self.loads += 1
+
+    def fields(self, index_name: str) -> dict[str, tuple[str, str]] | None:
+        """Fields of the index as last loaded, None if it does not exist"""
+        return self.indices.get(index_name)
+
+    def is_numeric(self, index_name: str, field: str) -> bool:
+        """Whether the field is a numeric field stored at the top of the docs"""
+        return (self.fields(index_name) or {}).get(field) == (f"$.{field}", "NUMERIC")
+
+
+index_registry = IndexRegistry()
 
 REDIS_SCHEMA_DATA_TYPES_MAPPER = {
     "string": TextField,
@@ -40,22 +164,83 @@ META_SCHEMA = (
 )
 
 
-def create_index(space_name: str, schema_name: str, redis_schema: tuple):
-    """
-    create redis schema index, drop it if exist first
+INDEX_VERSION = re.compile(r"^(?P<alias>.+):v(?P<version>\d+)$")
+
+
+def index_alias(index_name: str) -> str:
+    """Name searches use for an index: "<space>:<schema>" without the version"""
+    match = INDEX_VERSION.match(index_name)
+    return match["alias"] if match else index_name
+
+
+async def list_indices() -> list[str]:
+    return [_text(one) for one in await client.execute_command("FT._LIST")]
+
+
+async def index_versions(alias: str) -> dict[str, int]:
+    """Name and version of every built (or building) version of the index"""
+    versions = {}
+    for name in await list_indices():
+        match = INDEX_VERSION.match(name)
+        if match and match["alias"] == alias:
+            versions[name] = int(match["version"])
+    return versions
+
+
+async def create_index(space_name: str, schema_name: str, redis_schema: tuple) -> str:
     """
-    try:
-        redis_indices[space_name][schema_name].dropindex(delete_documents=True)
-    except:
-        pass
+    create the next version of the redis schema index, next to the serving one
 
-    redis_indices[space_name][schema_name].create_index(
+    Both versions index the same documents, so searches keep using the
+    serving version while the new one builds, until swap_index. Return the
+    name of the new version.
+    """
+    alias = f"{space_name}:{schema_name}"
+    versions = await index_versions(alias)
+    name = f"{alias}:v{max(versions.values(), default=0) + 1}"
+    redis_indices.setdefault(space_name, {})[schema_name] = client.ft(name)
+    await redis_indices[space_name][schema_name].create_index(
         redis_schema,
-        definition=IndexDefinition(
-            prefix=[f"{space_name}:{schema_name}"], index_type=IndexType.JSON
-        ),
+        definition=IndexDefinition(prefix=[alias], index_type=IndexType.JSON),
     )
-    # print(f"Created new index named {space_name}:{schema_name}\n")
+    return name
+
+
+async def wait_indexed(index_name: str, poll_seconds: float = 0.5):
+    """Wait for redis to finish indexing the documents already stored"""
+    while True:
+        info = await client.ft(index_name).info()
+        if not int(_text(info.get("indexing", 0))):
+            return
+        await asyncio.sleep(poll_seconds)
+
+
+async def swap_index(index_name: str):
+    """Point the alias of the index to this version, then drop the others
+
+    The alias moves in a single FT.ALIASUPDATE. Dropped versions keep the
+    documents, which the new version indexes too.
+    """
+    alias = index_alias(index_name)
+    if alias in await list_indices():
+        # Index made before versioning, its name is taken by the alias
+        await client.ft(alias).dropindex(delete_documents=False)
+    await client.ft(index_name).aliasupdate(alias)
+    for name in await index_versions(alias):
+        if name != index_name:
+            await client.ft(name).dropindex(delete_documents=False)
+    index_registry.invalidate()
+
+
+async def scan_docs(prefix: str) -> AsyncIterator[list[str]]:
+    """Yield the ids of the documents under the prefix, a batch at a time"""
+    cursor = 0
+    while True:
+        cursor, keys = await client.scan(cursor, match=f"{prefix}:*", count=500)
+        if keys:
+            yield [_text(one) for one in keys]
+        if not cursor:
+            return
 
 
 def get_redis_index_fields(key_chain, property, redis_schema_definition):
@@ -83,12 +268,14 @@ def get_redis_index_fields(key_chain, property, redis_schema_definition):
     return redis_schema_definition
 
 
-def create_indices_for_all_spaces_meta_and_schemas():
+async def create_indices_for_all_spaces_meta_and_schemas() -> list[str]:
     """
     Loop over all spaces, and for each one we create: (only if indexing_enabled is true for the space)
     1-index for meta file called space_name:meta
     2-indices for schema files called space_name:schema_shortname
+    Return the names of the new index versions, to swap in once loaded
     """
+    created: list[str] = []
     for space_name in settings.space_names:
         space_meta_file = settings.spaces_folder / space_name / ".dm/meta.space.json"
         if not space_meta_file.is_file():
@@ -102,9 +289,7 @@ def create_indices_for_all_spaces_meta_and_schemas():
             continue
 
         # CREATE REDIS INDEX FOR THE META FILES INSIDE THE SPACE
-        redis_indices[space_name] = {}
-        redis_indices[space_name]["meta"] = client.ft(f"{space_name}:meta")
-        create_index(space_name, "meta", META_SCHEMA)
+        created.append(await create_index(space_name, "meta", META_SCHEMA))
 
         # CREATE REDIS INDEX FOR EACH SCHEMA DEFINITION INSIDE THE SPACE
         schemas_file_pattern = re.compile(r"(\w*).json")
@@ -127,9 +312,6 @@ def create_indices_for_all_spaces_meta_and_schemas():
                 )
 
             if redis_schema_definition:
-                redis_indices[space_name][schema_shortname] = client.ft(
-                    f"{space_name}:{schema_shortname}"
-                )
                 redis_schema_definition.extend(
                     [
                         TextField("$.subpath", no_stem=True, as_name="subpath"),
@@ -140,9 +322,12 @@ def create_indices_for_all_spaces_meta_and_schemas():
                         TextField("$.meta_doc_id", no_stem=True, as_name="meta_doc_id"),
                     ]
                 )
-                create_index(
-                    space_name, schema_shortname, tuple(redis_schema_definition)
+                created.append(
+                    await create_index(
+                        space_name, schema_shortname, tuple(redis_schema_definition)
+                    )
                 )
+    return created
 
 
 def generate_doc_id(
@@ -151,9 +336,10 @@ def generate_doc_id(
     return f"{space_name}:{schema_shortname}:{subpath}/{shortname}"
 
 
-def save_meta_doc(
+def meta_doc(
     space_name: str, schema_shortname: str, subpath: str, meta: core.Meta
-):
+) -> tuple[str, dict]:
+    """Doc id and redis document of a meta"""
     resource_type = meta.__class__.__name__.lower()
     docid = generate_doc_id(space_name, schema_shortname, meta.shortname, subpath)
     meta_json = json.loads(meta.json(exclude_none=True))
@@ -164,16 +350,24 @@ def save_meta_doc(
     meta_json["created_at"] = meta.created_at.timestamp()
     meta_json["updated_at"] = meta.updated_at.timestamp()
     meta_json["tags"] = "none" if not meta.tags else "|".join(meta.tags)
-    client.json().set(docid, Path.root_path(), meta_json)
+    return docid, meta_json
+
+
+async def save_meta_doc(
+    space_name: str, schema_shortname: str, subpath: str, meta: core.Meta
+):
+    docid, meta_json = meta_doc(space_name, schema_shortname, subpath, meta)
+    await client.json().set(docid, Path.root_path(), meta_json)
 
 
-def save_payload_doc(
+def payload_doc(
     space_name: str,
     schema_shortname: str,
     subpath: str,
     payload_shortname,
     payload: dict,
-):
+) -> tuple[str, dict]:
+    """Doc id and redis document of a json payload following a schema"""
     meta_doc_id = generate_doc_id(space_name, "meta", payload_shortname, subpath)
     docid = generate_doc_id(space_name, schema_shortname, payload_shortname, subpath)
 
@@ -181,12 +375,36 @@ def save_payload_doc(
     payload["resource_type"] = "content"
     payload["shortname"] = payload_shortname
     payload["meta_doc_id"] = meta_doc_id
-    client.json().set(docid, Path.root_path(), payload)
+    return docid, payload
+
+
+async def save_payload_doc(
+    space_name: str,
+    schema_shortname: str,
+    subpath: str,
+    payload_shortname,
+    payload: dict,
+):
+    docid, payload = payload_doc(
+        space_name, schema_shortname, subpath, payload_shortname, payload
+    )
+    await client.json().set(docid, Path.root_path(), payload)
 
     # TBD : If entry of type content and json payload, save the json document under the respective schema index
 
 
-def search(
+async def write_docs(docs: dict[str, dict | None]):
+    """Set (or delete, when None) every document in a single round trip"""
+    pipeline = client.pipeline(transaction=False)
+    for docid, doc in docs.items():
+        if doc is None:
+            pipeline.delete(docid)
+        else:
+            pipeline.json().set(docid, Path.root_path(), doc)
+    await pipeline.execute()
+
+
+async def search(
     space_name: str,
     search: str,
     filters: dict[str:list],
@@ -194,12 +412,22 @@ def search(
     offset: int,
     sort_by: str | None = None,
     schema_name: str = "meta",
-):
-    ft_index = client.ft(f"{space_name}:{schema_name}")
-    try:
-        ft_index.info()
-    except:
+    after: dict | None = None,
+) -> tuple[int, list]:
+    """
+    Search the schema index and return the total and the docs of the page.
+    after is the position of the previous page: {"o": offset} or, when sorting
+    on a numeric field, {"v": last value, "n": docs already returned with it}.
+    The total then only counts the docs from that value on.
+    """
+    index_name = f"{space_name}:{schema_name}"
+    await index_registry.refresh()
+    fields = index_registry.fields(index_name)
+    if fields is None:
         raise Exception("Invalid space name or schema name")
+    if sort_by and sort_by not in fields:
+        return 0, []
+    ft_index = client.ft(index_name)
 
     query_string = search
 
@@ -210,6 +438,12 @@ def search(
         elif item[1]:
             query_string += " @" + item[0] + ":(" + "|".join(item[1]) + ")"
 
+    if after and "v" in after and sort_by:
+        query_string += f" @{sort_by}:[{after['v']} +inf]"
+        offset = after["n"]
+    elif after:
+        offset = after["o"]
+
     search_query = Query(query_string=query_string)
 
     if sort_by:
@@ -218,10 +452,24 @@ def search(
     search_query.paging(offset, limit)
 
     try:
-        return ft_index.search(query=search_query).docs
+        result = await ft_index.search(query=search_query)
+        return result.total, result.docs
     except:
-        return []
+        return 0, []
+
+
+async def get_doc_by_id(doc_id: str):
+    return await client.json().get(doc_id)
+
+
+async def get_docs_by_ids(doc_ids: list[str]) -> dict[str, dict]:
+    """Fetch the documents with a single JSON.MGET, missing ones are left out"""
+    doc_ids = list(dict.fromkeys(doc_ids))
+    if not doc_ids:
+        return {}
+    docs = await client.json().mget(doc_ids, Path.root_path())
+    return {docid: doc for docid, doc in zip(doc_ids, docs) if doc is not None}
 
 
-def get_doc_by_id(doc_id: str):
-    return client.json().get(name=doc_id)
+async def close():
+    await pool.disconnect()
@@ -0,0 +1,62 @@
+""" Compiled JSON-schema validators of the spaces
+
+Building a validator parses the schema file and checks the schema against its
+meta-schema, which costs far more than validating one payload. Validators are
+therefore built once per (space, schema shortname) and reused until the
+schema file changes on disk or its Schema meta is written.
+"""
+
+import os
+import threading
+import orjson
+from pathlib import Path
+from jsonschema import validators
+from jsonschema.protocols import Validator
+from utils.settings import settings
+
+
+def schema_path(space_name: str, schema_shortname: str) -> Path:
+    return settings.spaces_folder / space_name / "schema" / f"{schema_shortname}.json"
+
+
+class SchemaCache:
+    def __init__(self):
+        self.compiled = 0
+        self._validators: dict[tuple[str, str], tuple[tuple, Validator]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, space_name: str, schema_shortname: str) -> Validator:
+        """Validator of the schema, raise FileNotFoundError if missing"""
+        key = (space_name, schema_shortname)
+        path = schema_path(space_name, schema_shortname)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(space_name, schema_shortname)
+            raise
+        signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+        entry = self._validators.get(key)
+        if entry and entry[0] == signature:
+            return entry[1]
+
+        schema = orjson.loads(path.read_bytes())
+        validator_class = validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        with self._lock:
+            self._validators[key] = (signature, validator)
+            self.compiled += 1
+        return validator
+
+    def invalidate(self, space_name: str, schema_shortname: str):
+        with self._lock:
+            self._validators.pop((space_name, schema_shortname), None)
+
+    def validate(self, space_name: str, schema_shortname: str, data):
+        """Raise jsonschema.ValidationError if data does not match the schema"""
+        self.get(space_name, schema_shortname).validate(data)
+
+
+schema_cache = SchemaCache()
+
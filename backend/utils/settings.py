@@ -17,8 +17,28 @@ class Settings(BaseSettings):
     listening_host: str = "0.0.0.0"
     listening_port: int = 8282
     redis_host: str = "127.0.0.1"
+    redis_port: int = 6379
+    redis_pool_size: int = 20
+    redis_pool_timeout: float = 5
+    redis_socket_timeout: float = 5
+    redis_index_ttl: float = 60
     space_names: list[str] = []
     spaces_folder: Path = Path("../spaces/")
+    catalog_enabled: bool = False
+    meta_cache_size: int = 4096
+    fs_workers: int = 16
+    query_fanout: int = 8
+    prefetch_pages: bool = True
+    fsync_writes: bool = True
+    fsync_window_ms: float = 2
+    bulk_parallelism: int = 8
+    csv_import_chunk: int = 500
+    upload_buffer_size: int = 1024 * 1024
+    content_addressed_payloads: bool = False
+    indexer_batch_size: int = 500
+    indexer_retry_seconds: float = 1
+    reclaim_batch_size: int = 200
+    reclaim_pause_ms: float = 10
 
     class Config:
         """Load config"""
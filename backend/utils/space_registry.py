@@ -0,0 +1,79 @@
+""" In-memory registry of the space metas shared by the worker processes
+
+Every worker keeps the parsed `<space>/.dm/meta.space.json` files in memory.
+Writing a space meta touches a stamp file under `<spaces_folder>/.dm`; other
+workers stat that single file before serving and reload only when it changed,
+so listing the spaces costs one stat instead of a glob and a parse per space.
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+import models.core as core
+from utils.settings import settings
+
+STAMP_FILENAME = "spaces.stamp"
+
+
+class SpaceRegistry:
+    def __init__(self):
+        self.spaces: dict[str, core.Space] = {}
+        self.reloads = 0
+        self._signature: tuple | None = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp_path() -> Path:
+        return settings.spaces_folder / ".dm" / STAMP_FILENAME
+
+    def _stamp_signature(self) -> tuple | None:
+        try:
+            stat = os.stat(self.stamp_path())
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _load(self) -> dict[str, core.Space]:
+        spaces: dict[str, core.Space] = {}
+        try:
+            folders = os.scandir(settings.spaces_folder)
+        except FileNotFoundError:
+            return spaces
+        with folders:
+            for one in folders:
+                meta_file = Path(one.path) / ".dm" / "meta.space.json"
+                if one.is_dir() and meta_file.is_file():
+                    spaces[one.name] = core.Space.parse_raw(meta_file.read_text())
+        return dict(sorted(spaces.items()))
+
+    def refresh(self) -> dict[str, core.Space]:
+        """Reload the space metas if another worker (or this one) changed them
+
+        Always go through refresh, the dict returned is not updated afterwards
+        """
+        signature = self._stamp_signature()
+        if self._loaded and signature == self._signature:
+            return self.spaces
+        with self._lock:
+            if not self._loaded or signature != self._signature:
+                # A new dict is swapped in, the one handed out before is
+                # never changed under a reader still iterating it
+                self.spaces = self._load()
+                self._signature = signature
+                self._loaded = True
+                self.reloads += 1
+        return self.spaces
+
+    def notify(self):
+        """Announce that a space meta was written, to all the workers"""
+        stamp = self.stamp_path()
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        # Replacing the file changes its inode even within the mtime granularity
+        tmp = stamp.with_name(f"{STAMP_FILENAME}.{os.getpid()}.tmp")
+        tmp.write_text(str(time.time_ns()))
+        os.replace(tmp, stamp)
+
+
+space_registry = SpaceRegistry()
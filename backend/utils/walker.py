@@ -0,0 +1,95 @@
+""" Single-pass scandir walker over the .dm layout of a subpath
+
+    <subpath>/.dm/<shortname>/meta.<resource_type>.json            entry
+    <subpath>/.dm/<shortname>/attachments.<type>/meta.<name>.json  attachment
+    <subpath>/<shortname>/.dm/meta.folder.json                     sub folder
+"""
+
+import os
+from pathlib import Path
+from typing import Iterator, NamedTuple
+from models.enums import ResourceType
+
+RESOURCE_TYPES = {one.value for one in ResourceType}
+
+
+class Entry(NamedTuple):
+    kind: str  # entry, folder or attachment
+    shortname: str
+    resource_type: str
+    path: Path  # of the meta file
+
+
+def _meta_name(filename: str) -> str | None:
+    """Middle part of a meta.<name>.json filename"""
+    parts = filename.split(".")
+    if len(parts) == 3 and parts[0] == "meta" and parts[2] == "json" and parts[1]:
+        return parts[1]
+    return None
+
+
+def walk_subpath(path: Path) -> Iterator[Entry]:
+    """Yield the entries of the subpath, then its sub folders"""
+    try:
+        dm_entries = os.scandir(path / ".dm")
+    except (FileNotFoundError, NotADirectoryError):
+        dm_entries = None
+    if dm_entries:
+        with dm_entries:
+            for one in dm_entries:
+                if not one.is_dir():
+                    continue
+                with os.scandir(one.path) as entry_files:
+                    for meta_file in entry_files:
+                        resource_type = _meta_name(meta_file.name)
+                        if resource_type in RESOURCE_TYPES and meta_file.is_file():
+                            yield Entry(
+                                "entry", one.name, resource_type, Path(meta_file.path)
+                            )
+
+    try:
+        subfolders = os.scandir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with subfolders:
+        for one in subfolders:
+            if one.name == ".dm" or not one.is_dir():
+                continue
+            meta_file = Path(one.path) / ".dm" / "meta.folder.json"
+            if meta_file.is_file():
+                yield Entry("folder", one.name, "folder", meta_file)
+
+
+def walk_attachments(entry_path: Path) -> Iterator[Entry]:
+    """Yield the attachments of the entry stored in entry_path (.dm/<shortname>)"""
+    try:
+        entry_dirs = os.scandir(entry_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entry_dirs:
+        for one in entry_dirs:
+            prefix, _, resource_type = one.name.partition(".")
+            if (
+                prefix != "attachments"
+                or resource_type not in RESOURCE_TYPES
+                or not one.is_dir()
+            ):
+                continue
+            with os.scandir(one.path) as attachment_files:
+                for meta_file in attachment_files:
+                    shortname = _meta_name(meta_file.name)
+                    if shortname and meta_file.is_file():
+                        yield Entry(
+                            "attachment", shortname, resource_type, Path(meta_file.path)
+                        )
+
+
+def walk_tree(path: Path) -> Iterator[tuple[str, Entry]]:
+    """Yield (relative subpath, entry) for every entry and sub folder of the tree"""
+    for dirpath, dirnames, _ in os.walk(path):
+        if ".dm" in dirnames:
+            dirnames.remove(".dm")
+        folder = Path(dirpath)
+        relative = str(folder.relative_to(path))
+        for one in walk_subpath(folder):
+            yield ("" if relative == "." else relative), one